@@ -4,25 +4,107 @@ from PyQt5.QtGui import QColor
 from PyQt5.QtWidgets import QApplication, QMainWindow, QFileDialog, QMessageBox, QTableWidgetItem
 
 import os
-import struct
-import pydicom
+import time
 import numpy as np
-from ct_image import ct_img
-
-from matplotlib.backends.qt_compat import is_pyqt5
+import ct_profile
+from collections import deque
+from ct_image import ct_img, dicom_watcher, dose_overlay, WINDOW_PRESETS, DOSE_LEVELS, window_lut, apply_lut, hu_conversion_luts, matching_err_files, box_histogram, histogram_stats
+
+try:
+    from matplotlib.backends.qt_compat import is_pyqt5
+except ImportError:  # removed in matplotlib 3.5, which no longer supports Qt4
+    is_pyqt5 = lambda: True
 if is_pyqt5():
     from matplotlib.backends.backend_qt5agg import FigureCanvas
 else:
     from matplotlib.backends.backend_qt4agg import FigureCanvas
 
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib.patches import Circle
-from matplotlib.colors import LogNorm
+from matplotlib.transforms import Bbox
+
+SUMMED_VOLUME_MAX_VOXELS = 2**31   # summed-volume tables over 4^3 blocks take 1/4 byte per voxel (512 MB here)
+BOX_HISTOGRAM_VOXELS = 2**22       # voxels sampled per live cut-box histogram
+
+class renderScheduler(QtCore.QObject):
+    # Coalesce redraw requests: only the latest view state is rendered, at most
+    # max_fps times per second.  Requests merged into a pending render count as
+    # dropped frames.
+    def __init__(self, render, max_fps=30, parent=None):
+        super(renderScheduler, self).__init__(parent)
+        self.render = render
+        self.interval = 1. / max_fps
+        self.enforce_refresh = False
+        self.last_render = 0.
+        self.rendered_frames = 0
+        self.dropped_frames = 0
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.flush)
+
+    def request(self, enforce_refresh=False):
+        self.enforce_refresh = self.enforce_refresh or enforce_refresh
+        if self.timer.isActive():
+            self.dropped_frames += 1
+            return
+        wait = self.interval - (time.perf_counter() - self.last_render)
+        self.timer.start(max(0, int(wait * 1000)))
+
+    def cancel(self):
+        if self.timer.isActive():
+            self.timer.stop()
+            self.dropped_frames += 1
+        self.enforce_refresh = False
+
+    def flush(self):
+        enforce_refresh = self.enforce_refresh
+        self.enforce_refresh = False
+        self.last_render = time.perf_counter()
+        self.rendered_frames += 1
+        self.render(enforce_refresh)
+
+
+class loadWorker(QtCore.QThread):
+    # Run a loading job off the GUI thread.  The job receives the worker, emits
+    # volume_ready as soon as something can be displayed, reports progress (with stage
+    # naming what is counted), and returns False if it stopped early because cancel()
+    # was called.
+    volume_ready = QtCore.pyqtSignal(object)
+    progress = QtCore.pyqtSignal(int, int)
+    stage = QtCore.pyqtSignal(str)
+    failed = QtCore.pyqtSignal(str)
+    done = QtCore.pyqtSignal(bool)
+
+    def __init__(self, job, parent=None):
+        super(loadWorker, self).__init__(parent)
+        self.job = job
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report(self, stage):
+        # progress callback for the per-slab loops of ct_img, which stop when it returns False
+        self.stage.emit(stage)
+        def callback(done, total):
+            self.progress.emit(done, total)
+            return not self.cancelled
+        return callback
+
+    def run(self):
+        try:
+            complete = self.job(self)
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.done.emit(complete)
+
 
 class myApp(QMainWindow):
     def __init__(self):
         super(myApp, self).__init__()
-        uic.loadUi('CT_gui.ui', self)
+        uic.loadUi(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'CT_gui.ui'), self)
 
         self.defaultWindowTitle = 'DICOM-CT Tool'
         self.setWindowTitle(self.defaultWindowTitle)
@@ -37,22 +119,71 @@ class myApp(QMainWindow):
             [self.spinBox_x2, self.spinBox_y2, self.spinBox_z2] ]
         self.with_dose = False
         self.hold_display_refresh = False
+        self.scheduler = renderScheduler(self.display, parent=self)
+        self.loader = None
+        self.volume_changed = False
+        self.lut = window_lut(*WINDOW_PRESETS['Wide'])
+        self.hold_window_update = False
+        self.dose_levels = DOSE_LEVELS
+        self.overlay = None
             
         # add matplotlib canvas
         self.fig = plt.figure(figsize=(8,6), dpi=100, facecolor='white')
         self.canvas = FigureCanvas(self.fig)
-        self.canvas.move(10,150)
+        self.canvas.move(10,177)
         self.canvas.setParent(self)
         self.firstDraw = True
+        self.backgrounds = None
         self.fig.canvas.mpl_connect('motion_notify_event', self.mouse_move)
+        self.fig.canvas.mpl_connect('draw_event', self.canvas_drawn)
         # self.addToolBar(NavigationToolbar(self.canvas, self))
 
+        # HU statistics and histogram of the cut box, right of the views
+        self.hist_fig = Figure(figsize=(2.75, 3), dpi=100, facecolor='white')
+        self.hist_ax = self.hist_fig.add_subplot(1, 1, 1)
+        self.hist_canvas = FigureCanvas(self.hist_fig)
+        self.hist_canvas.setParent(self)
+        self.hist_canvas.move(815, 177)
+        self.label_box_stats = QtWidgets.QLabel(self)
+        self.label_box_stats.setGeometry(825, 485, 265, 100)
+        self.label_box_stats.setAlignment(QtCore.Qt.AlignLeft | QtCore.Qt.AlignTop)
+        self.stats_scheduler = renderScheduler(self.updateBoxStats, max_fps=10, parent=self)
+        self.box_range = None
+
+        # loading progress and cancel in the status bar
+        self.progressBar = QtWidgets.QProgressBar()
+        self.progressBar.setMaximumWidth(200)
+        self.progressBar.setVisible(False)
+        self.statusBar.addPermanentWidget(self.progressBar)
+        self.botton_cancel_load = QtWidgets.QPushButton('Cancel')
+        self.botton_cancel_load.setVisible(False)
+        self.statusBar.addPermanentWidget(self.botton_cancel_load)
+
+        # live frame time and export of the timing trace
+        ct_profile.enable()
+        self.frame_times = deque()
+        self.label_frame_time = QtWidgets.QLabel()
+        self.statusBar.addPermanentWidget(self.label_frame_time)
+        self.botton_export_trace = QtWidgets.QPushButton('Trace')
+        self.botton_export_trace.setToolTip('Save the recorded stage timings as a trace file')
+        self.statusBar.addPermanentWidget(self.botton_export_trace)
+
         # signal actions
         self.botton_open_folder.clicked.connect(self.openFolder)
         self.botton_open_file.clicked.connect(self.openFile)
+        self.botton_watch_folder.clicked.connect(self.watchFolder)
         self.botton_write_img.clicked.connect(self.saveImg)
         self.botton_open_dose.clicked.connect(self.openDose)
-        self.checkBox_center_lines.stateChanged.connect(lambda:self.display(True))
+        self.botton_sum_doses.clicked.connect(self.sumDoses)
+        self.botton_cancel_load.clicked.connect(self.cancelLoad)
+        self.botton_export_trace.clicked.connect(self.exportTrace)
+        self.comboBox_window.currentIndexChanged.connect(self.window_preset_changed)
+        self.spinBox_level.valueChanged.connect(self.window_value_changed)
+        self.spinBox_width.valueChanged.connect(self.window_value_changed)
+        self.lineEdit_dose_levels.editingFinished.connect(self.dose_levels_changed)
+        self.comboBox_projection.currentIndexChanged.connect(self.projection_changed)
+        self.spinBox_slab.valueChanged.connect(self.projection_changed)
+        self.checkBox_center_lines.stateChanged.connect(lambda:self.scheduler.request(True))
 
         self.spinBox_x0.valueChanged.connect(self.spin0_value_changed)
         self.spinBox_y0.valueChanged.connect(self.spin0_value_changed)
@@ -61,6 +192,8 @@ class myApp(QMainWindow):
         self.hSlider_x0.valueChanged.connect(self.slider_value_changed)
         self.hSlider_y0.valueChanged.connect(self.slider_value_changed)
         self.hSlider_z0.valueChanged.connect(self.slider_value_changed)
+        for slider in (self.hSlider_x0, self.hSlider_y0, self.hSlider_z0):
+            slider.sliderReleased.connect(self.slider_released)
 
         for i in range(1,3):
             for spinBox in self.spinBoxList[i]:
@@ -88,88 +221,306 @@ class myApp(QMainWindow):
 
 
     def openFolder(self):
-        self.folder = QFileDialog.getExistingDirectory(self, 'Select Directory', '.')
-        if self.folder:
-            files = [f for f in os.listdir(self.folder) if f.endswith('.dcm')]
+        folder = QFileDialog.getExistingDirectory(self, 'Select Directory', '.')
+        if folder:
+            files = [f for f in os.listdir(folder) if f.endswith('.dcm')]
             if(len(files) > 0):
-                self.ct = ct_img(self.folder)
-                self.hold_display_refresh = True
-
-                self.dicom_name = self.folder
-                self.setWindowTitle(self.defaultWindowTitle + ': ' + self.dicom_name)
-                self.botton_write_img.setEnabled(True)
-
-                self.table_DICOM.setRowCount(5)
-                self.table_DICOM.setItem(0, 0, QTableWidgetItem('Voxel Num'))
-                self.table_DICOM.setItem(0, 1, QTableWidgetItem('{:d} x {:d} x {:d}'.format(self.ct.nx, self.ct.ny, self.ct.nz)))
-                self.table_DICOM.setItem(1, 0, QTableWidgetItem('Voxel Size'))
-                self.table_DICOM.setItem(1, 1, QTableWidgetItem('{:.2f} x {:.2f} x {:.2f} mm'.format(self.ct.dx, self.ct.dy, self.ct.dz)))
-            
-                ds = pydicom.dcmread(files[0])
-                self.table_DICOM.setItem(2, 0, QTableWidgetItem('Rescale Slope'))
-                self.table_DICOM.setItem(2, 1, QTableWidgetItem('{:}'.format(ds.RescaleSlope)))
-                self.table_DICOM.setItem(3, 0, QTableWidgetItem('Rescale Intercept'))
-                self.table_DICOM.setItem(3, 1, QTableWidgetItem('{:}'.format(ds.RescaleIntercept)))
-                if ds.RescaleIntercept != 0:  # rescale voxel data to make water HU=0
-                    self.ct.voxel += np.int16(ds.RescaleIntercept)
-
-                try:
-                    rescale_type = '{:}'.format(ds.RescaleType)
-                except:
-                    rescale_type = 'Not Defined'
-                self.table_DICOM.setItem(4, 0, QTableWidgetItem('Rescale Type'))
-                self.table_DICOM.setItem(4, 1, QTableWidgetItem(rescale_type))
-
-                self.table_DICOM.resizeColumnsToContents()
-                self.table_DICOM.resizeRowsToContents()
-
-                self.setDefaultPlanes()
-                self.botton_open_dose.setEnabled(True)
-
-                self.display(True)
+                self.folder = folder
+                self.startLoad(self.loadFolderJob, self.folderReady)
             else:
-                self.showErrMsg('No DICOM files (.dcm) are found in the selected folder.')
+                self.showMsg('No DICOM files (.dcm) are found in the selected folder.')
+
+
+    def loadFolderJob(self, worker):
+        # runs on the loader thread: headers first, then slices streamed into the volume
+        ct = ct_img()
+        ct.dir = self.folder
+        ct.read_dicom_headers(self.folder)
+        ct.voxel = np.zeros((ct.nz, ct.ny, ct.nx), dtype=np.int16)
+        worker.volume_ready.emit(ct)
+
+        count = [0]
+        def slice_done(i):
+            count[0] += 1
+            worker.progress.emit(count[0], ct.nz)
+            return not worker.cancelled
+
+        # decode from the default display plane outwards so the first views fill in early
+        order = sorted(range(ct.nz), key=lambda i: abs(i - ct.nz // 2))
+        complete = ct.decode_dicom(order=order, callback=slice_done)
+        # the volume is complete even if the pyramid or the tables are cancelled
+        if complete and ct.build_pyramid(callback=worker.report('pyramid slices')) is not None:
+            if ct.nx * ct.ny * ct.nz <= SUMMED_VOLUME_MAX_VOXELS:
+                ct.build_summed_volume(callback=worker.report('summed-volume slices'))
+        return complete
+
+
+    def folderReady(self, ct):
+        self.ct = ct
+        self.with_dose = False
+        self.hold_display_refresh = True
+
+        self.dicom_name = self.folder
+        self.setWindowTitle(self.defaultWindowTitle + ': ' + self.dicom_name)
+
+        self.table_DICOM.setRowCount(5)
+        self.table_DICOM.setItem(0, 0, QTableWidgetItem('Voxel Num'))
+        self.table_DICOM.setItem(0, 1, QTableWidgetItem('{:d} x {:d} x {:d}'.format(self.ct.nx, self.ct.ny, self.ct.nz)))
+        self.table_DICOM.setItem(1, 0, QTableWidgetItem('Voxel Size'))
+        self.table_DICOM.setItem(1, 1, QTableWidgetItem('{:.2f} x {:.2f} x {:.2f} mm'.format(self.ct.dx, self.ct.dy, self.ct.dz)))
+
+        self.table_DICOM.setItem(2, 0, QTableWidgetItem('Rescale Slope'))
+        self.table_DICOM.setItem(2, 1, QTableWidgetItem('{:}'.format(self.ct.rescale_slope)))
+        self.table_DICOM.setItem(3, 0, QTableWidgetItem('Rescale Intercept'))
+        self.table_DICOM.setItem(3, 1, QTableWidgetItem('{:}'.format(self.ct.rescale_intercept)))
+        self.table_DICOM.setItem(4, 0, QTableWidgetItem('Rescale Type'))
+        self.table_DICOM.setItem(4, 1, QTableWidgetItem(self.ct.rescale_type))
+
+        self.table_DICOM.resizeColumnsToContents()
+        self.table_DICOM.resizeRowsToContents()
+
+        self.setDefaultPlanes()
+
+        self.firstDraw = True
+        self.display(True)
+
+
+    def watchFolder(self):
+        # review a study while the scanner is still writing it: new slices are added as they arrive
+        folder = QFileDialog.getExistingDirectory(self, 'Select Directory to Watch', '.')
+        if folder:
+            self.folder = folder
+            self.watch_ct = ct_img()
+            self.watch_ct.dir = folder
+            self.startLoad(self.watchFolderJob, self.slicesArrived, 'slices, watching for more')
+
+
+    def watchFolderJob(self, worker, interval=1.):
+        # runs on the loader thread until cancelled: decodes new files, the GUI thread inserts them
+        watcher = dicom_watcher(self.folder)
+        count = 0
+        while not worker.cancelled:
+            slices = watcher.poll()
+            if slices:
+                count += len(slices)
+                worker.volume_ready.emit(slices)
+                worker.progress.emit(count, count)
+            for i in range(int(interval * 10)):
+                if worker.cancelled:
+                    break
+                time.sleep(0.1)
+        return True
+
+
+    def slicesArrived(self, slices):
+        first = self.watch_ct.nz == 0
+        old_nz = self.watch_ct.nz
+        positions = self.watch_ct.insert_slices(slices)
+        if first:
+            self.folderReady(self.watch_ct)
+            return
+        if self.ct is not self.watch_ct:
+            return
+
+        # widen the z ranges and keep the same slices in view and in the cut box
+        # a cut box reaching the first or last slice keeps reaching it
+        z0, z1, z2 = self.spinBox_z0.value(), self.spinBox_z1.value(), self.spinBox_z2.value()
+        at_start, at_end = z1 == 0, z2 == old_nz - 1
+        for i in positions:
+            z0 = z0 + (i <= z0)
+            z1 = 0 if at_start else z1 + (i <= z1)
+            z2 = self.ct.nz - 1 if at_end else z2 + (i <= z2)
+        for widget in (self.spinBox_z0, self.spinBox_z2, self.hSlider_z0):
+            widget.setMaximum(self.ct.nz - 1)
+        self.spinBox_z2.setValue(z2)   # the maximum of z1 follows z2
+        self.spinBox_z1.setValue(z1)
+        self.spinBox_z0.setValue(z0)
+        self.table_DICOM.setItem(0, 1, QTableWidgetItem('{:d} x {:d} x {:d}'.format(self.ct.nx, self.ct.ny, self.ct.nz)))
+        self.firstDraw = True   # the side views change shape, so the layout is rebuilt
+        self.scheduler.request(True)
+        self.stats_scheduler.request()
 
 
     def openFile(self):
         filename, _ = QFileDialog.getOpenFileName(self, 'Select Img File', filter='*.img')
         if filename:
             self.folder = os.path.dirname(filename)
-            self.ct = ct_img(filename)
-            self.hold_display_refresh = True
+            self.img_filename = filename
+            self.startLoad(self.loadFileJob, self.fileReady)
 
-            self.dicom_name = os.path.basename(filename)
-            self.setWindowTitle(self.defaultWindowTitle + ': ' + self.dicom_name)
-            self.lineEdit_imgFilename.setText(os.path.basename(filename))
-            self.botton_write_img.setEnabled(True)
-            self.botton_open_dose.setEnabled(True)
-            self.setDefaultPlanes()
 
-            self.table_DICOM.setRowCount(2)
-            self.table_DICOM.setItem(0, 0, QTableWidgetItem('Voxel Num'))
-            self.table_DICOM.setItem(0, 1, QTableWidgetItem('{:d} x {:d} x {:d}'.format(self.ct.nx, self.ct.ny, self.ct.nz)))
-            self.table_DICOM.setItem(1, 0, QTableWidgetItem('Voxel Size'))
-            self.table_DICOM.setItem(1, 1, QTableWidgetItem('{:.2f} x {:.2f} x {:.2f} mm'.format(self.ct.dx, self.ct.dy, self.ct.dz)))
-            self.table_DICOM.resizeColumnsToContents()
-            self.table_DICOM.resizeRowsToContents()
+    def loadFileJob(self, worker):
+        ct = ct_img(self.img_filename, mmap=True)
+        worker.volume_ready.emit(ct)
+        if ct.load_pyramid(self.img_filename, callback=worker.report('pyramid slices')) is not None:
+            if ct.nx * ct.ny * ct.nz <= SUMMED_VOLUME_MAX_VOXELS:
+                ct.build_summed_volume(callback=worker.report('summed-volume slices'))
+        return True
+
+
+    def fileReady(self, ct):
+        self.ct = ct
+        self.with_dose = False
+        self.hold_display_refresh = True
 
-            self.display(True)
+        self.dicom_name = os.path.basename(self.img_filename)
+        self.setWindowTitle(self.defaultWindowTitle + ': ' + self.dicom_name)
+        self.lineEdit_imgFilename.setText(os.path.basename(self.img_filename))
+        self.setDefaultPlanes()
+
+        self.table_DICOM.setRowCount(2)
+        self.table_DICOM.setItem(0, 0, QTableWidgetItem('Voxel Num'))
+        self.table_DICOM.setItem(0, 1, QTableWidgetItem('{:d} x {:d} x {:d}'.format(self.ct.nx, self.ct.ny, self.ct.nz)))
+        self.table_DICOM.setItem(1, 0, QTableWidgetItem('Voxel Size'))
+        self.table_DICOM.setItem(1, 1, QTableWidgetItem('{:.2f} x {:.2f} x {:.2f} mm'.format(self.ct.dx, self.ct.dy, self.ct.dz)))
+        self.table_DICOM.resizeColumnsToContents()
+        self.table_DICOM.resizeRowsToContents()
+
+        self.firstDraw = True
+        self.display(True)
 
 
     def openDose(self):
         filename, _ = QFileDialog.getOpenFileName(self, 'Select Dose File', filter='*.dose;*.err')
         if filename:
-            try:
-                self.ct.read_dose(filename)
-                self.setWindowTitle(self.defaultWindowTitle + ': ' + self.dicom_name + ' + ' + os.path.basename(filename))
-                self.hold_display_refresh = True
-                self.spinBox_x0.setValue(self.ct.dose_x)
-                self.spinBox_z0.setValue(self.ct.dose_z)
-                self.with_dose = True
-                self.checkBox_center_lines.setChecked(False)
-                self.display(True)
-            except Exception as e:
-                self.showMsg(str(e))
+            self.dose_filename = filename
+            self.startLoad(self.loadDoseJob, self.doseReady, 'dose slices')
+
+
+    def loadDoseJob(self, worker):
+        # the mapped dose is scanned once off the GUI thread, before it replaces the current one
+        if not self.ct.read_dose(self.dose_filename, mmap=True, callback=worker.report('dose slices')):
+            return False
+        worker.volume_ready.emit(self.dose_filename)
+        return True
+
+
+    def sumDoses(self):
+        filenames, _ = QFileDialog.getOpenFileNames(self, 'Select Dose Files', filter='*.dose')
+        if not filenames:
+            return
+        text, ok = QtWidgets.QInputDialog.getText(self, 'Dose Weights', 'Weight of each dose file (negative to subtract):',
+                                                  text=', '.join(['1'] * len(filenames)))
+        if not ok:
+            return
+        try:
+            weights = [float(v) for v in text.replace(',', ' ').split()]
+            if len(weights) != len(filenames):
+                raise ValueError
+        except ValueError:
+            self.showMsg('One weight is needed for each of the {:d} dose files.'.format(len(filenames)))
+            return
+        self.dose_files = filenames
+        self.dose_weights = weights
+        self.startLoad(self.sumDosesJob, self.doseReady, 'dose files')
+
+
+    def sumDosesJob(self, worker):
+        # matching .err files, if every dose file has one, are combined into the uncertainty
+        def file_done(i):
+            worker.progress.emit(i + 1, len(self.dose_files))
+            return not worker.cancelled
+        complete = self.ct.sum_doses(self.dose_files, self.dose_weights, matching_err_files(self.dose_files), callback=file_done)
+        if complete:
+            self.ct.dose_pct.block_max()
+            worker.volume_ready.emit('{:d} dose files'.format(len(self.dose_files)))
+        return complete
+
+
+    def doseReady(self, filename):
+        self.setWindowTitle(self.defaultWindowTitle + ': ' + self.dicom_name + ' + ' + os.path.basename(filename))
+        self.hold_display_refresh = True
+        self.spinBox_x0.setValue(self.ct.dose_x)
+        self.spinBox_z0.setValue(self.ct.dose_z)
+        self.with_dose = True
+        self.firstDraw = True
+        self.checkBox_center_lines.setChecked(False)
+        self.display(True)
+
+
+    def startLoad(self, job, ready, unit='slices'):
+        if self.loader is not None and self.loader.isRunning():
+            self.loader.cancel()
+            self.loader.wait()
+        self.botton_write_img.setEnabled(False)
+        self.botton_open_dose.setEnabled(False)
+        self.botton_sum_doses.setEnabled(False)
+        self.progressBar.setValue(0)
+        self.progressBar.setVisible(True)
+        self.botton_cancel_load.setVisible(True)
+        self.last_stream_refresh = time.perf_counter()
+
+        self.load_ready = ready
+        self.load_unit = unit
+        self.loader = loadWorker(job, self)
+        self.loader.volume_ready.connect(self.loadReady)
+        self.loader.progress.connect(self.loadProgress)
+        self.loader.stage.connect(self.loadStage)
+        self.loader.failed.connect(self.loadFailed)
+        self.loader.done.connect(self.loadDone)
+        self.loader.start()
+
+
+    def cancelLoad(self):
+        if self.loader is not None:
+            self.loader.cancel()
+
+
+    def loadReady(self, obj):
+        # signals still queued from a replaced loader are ignored
+        if self.sender() is self.loader:
+            self.load_ready(obj)
+
+
+    def loadStage(self, unit):
+        if self.sender() is self.loader:
+            self.load_unit = unit
+
+
+    def loadProgress(self, done, total):
+        if self.sender() is not self.loader:
+            return
+        self.progressBar.setMaximum(total)
+        self.progressBar.setValue(done)
+        self.statusBar.showMessage('Loading {:d} / {:d} {:}'.format(done, total, self.load_unit))
+        if self.load_unit != 'slices':
+            return
+        self.ct.clear_projections()
+        # show newly decoded slices a few times per second while the rest stream in
+        if time.perf_counter() - self.last_stream_refresh > 0.25 and not self.firstDraw:
+            self.last_stream_refresh = time.perf_counter()
+            self.volume_changed = True
+            self.scheduler.request(True)
+
+
+    def loadFailed(self, text):
+        if self.sender() is not self.loader:
+            return
+        self.progressBar.setVisible(False)
+        self.botton_cancel_load.setVisible(False)
+        if hasattr(self, 'ct'):
+            self.botton_write_img.setEnabled(True)
+            self.botton_open_dose.setEnabled(True)
+            self.botton_sum_doses.setEnabled(True)
+        self.showMsg(text)
+
+
+    def loadDone(self, complete):
+        if self.sender() is not self.loader:
+            return
+        self.progressBar.setVisible(False)
+        self.botton_cancel_load.setVisible(False)
+        self.botton_open_dose.setEnabled(True)
+        self.botton_sum_doses.setEnabled(True)
+        if complete or self.load_unit in ('dose files', 'dose slices'):  # a cancelled dose load leaves volume and dose as they were
+            self.botton_write_img.setEnabled(True)
+        if complete:
+            self.statusBar.showMessage('Loaded ' + self.dicom_name, 3000)
+        else:  # a partly loaded volume stays on screen but cannot be saved
+            self.statusBar.showMessage('Loading cancelled')
+        self.volume_changed = True
+        self.scheduler.request(True)
+        self.stats_scheduler.request()
 
 
     def saveImg(self):
@@ -192,12 +543,12 @@ class myApp(QMainWindow):
             z1 = self.spinBox_z1.value()
             z2 = self.spinBox_z2.value()
 
-            with open(filename, 'wb') as f:
-                f.write(struct.pack('iii', x2-x1+1, y2-y1+1, z2-z1+1))
-                f.write(struct.pack('fff', self.ct.dx, self.ct.dy, self.ct.dz))
-                f.write(self.ct.voxel[z1:z2+1, y1:y2+1, x1:x2+1].tobytes())
-                f.close()
-                self.showMsg(filename + ' saved.', error=False)
+            version = 2 if self.checkBox_compress.isChecked() else 1
+            hu_luts = hu_conversion_luts() if self.checkBox_density.isChecked() else None
+            self.ct.write_img(filename, box=(x1, x2, y1, y2, z1, z2), version=version, hu_luts=hu_luts)
+            if hu_luts is not None:
+                filename += ' and its density and material volumes'
+            self.showMsg(filename + ' saved.', error=False)
             return True
         
         else:  # No file is saved
@@ -205,6 +556,8 @@ class myApp(QMainWindow):
 
 
     def setDefaultPlanes(self):
+        # the cut box statistics wait for the first histogram of the new volume
+        self.box_range = None
         # The maximum of spinBox and Slider must be set before setting their values
         for i in range(3):
             self.spinBoxList[i][0].setMaximum(self.ct.nx - 1)
@@ -236,7 +589,7 @@ class myApp(QMainWindow):
             self.hSlider_y0.setValue(self.spinBox_y0.value())
         if sender == self.spinBox_z0:
             self.hSlider_z0.setValue(self.spinBox_z0.value())
-        self.display()
+        self.scheduler.request()
 
 
     def slider_value_changed(self):
@@ -258,7 +611,125 @@ class myApp(QMainWindow):
         self.spinBox_y2.setMinimum(self.spinBox_y1.value())
         self.spinBox_z2.setMinimum(self.spinBox_z1.value())
 
-        self.display(True)
+        self.scheduler.request(True)
+        self.updateBoxMoments()
+        self.stats_scheduler.request()
+
+
+    def window_preset_changed(self):
+        preset = self.comboBox_window.currentText()
+        if preset in WINDOW_PRESETS:
+            level, width = WINDOW_PRESETS[preset]
+            self.hold_window_update = True
+            self.spinBox_level.setValue(level)
+            self.spinBox_width.setValue(width)
+            self.hold_window_update = False
+            self.window_value_changed()
+
+
+    def window_value_changed(self):
+        if self.hold_window_update:
+            return
+        level = self.spinBox_level.value()
+        width = self.spinBox_width.value()
+        preset = [name for name, value in WINDOW_PRESETS.items() if value == (level, width)]
+        self.comboBox_window.blockSignals(True)
+        self.comboBox_window.setCurrentText(preset[0] if preset else 'Custom')
+        self.comboBox_window.blockSignals(False)
+
+        # the lookup table is rebuilt only here; each frame is a single table lookup per plane
+        self.lut = window_lut(level, width)
+        if not self.firstDraw:
+            self.volume_changed = True
+            self.scheduler.request(True)
+
+
+    def projection_changed(self):
+        self.spinBox_slab.setEnabled(self.comboBox_projection.currentText() != 'Plane')
+        if not self.firstDraw:
+            self.volume_changed = True
+            self.scheduler.request(True)
+
+
+    def dose_levels_changed(self):
+        try:
+            levels = sorted(float(v) for v in self.lineEdit_dose_levels.text().replace(',', ' ').split())
+            if len(levels) < 2 or levels[0] <= 0:
+                raise ValueError
+        except ValueError:
+            self.showMsg('Dose levels must be at least two positive numbers in percent.')
+            self.lineEdit_dose_levels.setText(', '.join('{:g}'.format(v) for v in self.dose_levels))
+            return
+        if levels != self.dose_levels:
+            self.dose_levels = levels
+            if self.with_dose:  # overlays and colorbar are rebuilt with the new levels
+                self.firstDraw = True
+                self.display(True)
+
+
+    def cutBox(self):
+        return tuple(s.value() for s in (self.spinBox_x1, self.spinBox_x2, self.spinBox_y1,
+                                         self.spinBox_y2, self.spinBox_z1, self.spinBox_z2))
+
+
+    def updateBoxMoments(self):
+        # mean and std from the summed-volume tables follow every change of the cut box;
+        # the histogram, min and max follow at the pace of stats_scheduler
+        if not hasattr(self, 'ct') or self.ct.summed is None or self.box_range is None:
+            return
+        with ct_profile.timer('box_moments'):
+            self.box_moments = self.ct.box_stats(self.cutBox())
+        self.showBoxStats()
+
+
+    def updateBoxStats(self, enforce_refresh=False):
+        if not hasattr(self, 'ct'):
+            return
+        box = self.cutBox()
+        size = (box[1]-box[0]+1) * (box[3]-box[2]+1) * (box[5]-box[4]+1)
+        # large boxes are sampled on a coarser grid to keep the histogram live
+        step = max(1, int(np.ceil((size / BOX_HISTOGRAM_VOXELS) ** (1/3))))
+        with ct_profile.timer('box_histogram'):
+            counts = box_histogram(self.ct.voxel, box, step)
+        n, mean, std, vmin, vmax = histogram_stats(counts)
+        if vmin is None:
+            return
+        if self.ct.summed is not None:
+            with ct_profile.timer('box_moments'):
+                self.box_moments = self.ct.box_stats(box)
+        else:   # n only counts the sampled voxels
+            self.box_moments = (size, mean, std)
+        self.box_range = (vmin, vmax, step)
+
+        # at most 100 bins over the occupied HU range
+        width = -(-(vmax - vmin + 1) // 100)
+        counts = counts[vmin + 32768 : vmax + 32769]
+        counts = np.pad(counts, (0, -len(counts) % width)).reshape(-1, width).sum(axis=1)
+        self.hist_ax.clear()
+        self.hist_ax.stairs(counts, vmin + width * np.arange(len(counts) + 1), fill=True)
+        self.hist_ax.set_yscale('log')
+        self.hist_ax.set_xlabel('HU')
+        self.hist_ax.set_title('Cut box' if step == 1 else 'Cut box (every {:d}th voxel)'.format(step), fontsize=9)
+        self.hist_ax.tick_params(labelsize=8)
+        self.hist_fig.tight_layout()
+        self.hist_canvas.draw()
+        self.showBoxStats()
+
+
+    def showBoxStats(self):
+        n, mean, std = self.box_moments
+        vmin, vmax, step = self.box_range
+        text = '{:d} voxels\nMean {:.1f} HU\nStd {:.1f} HU\nMin {:d} HU\nMax {:d} HU'.format(n, mean, std, vmin, vmax)
+        if step > 1:
+            text += '\n(min/max sampled)' if self.ct.summed is not None else '\n(sampled)'
+        self.label_box_stats.setText(text)
+
+
+    def exportTrace(self):
+        filename, _ = QFileDialog.getSaveFileName(self, 'Save Trace File', 'ct_trace.json', filter='*.json')
+        if filename:
+            ct_profile.export_trace(filename)
+            self.showMsg(filename + ' saved.\n\n' + ct_profile.report(), error=False)
 
 
     def mouse_move(self, event):
@@ -268,14 +739,16 @@ class myApp(QMainWindow):
 
         x, y = int(event.xdata), int(event.ydata)
         if ax == self.pxy:
-            HU = self.ct.voxel[self.spinBox_z0.value(), y, x]
-            msg = 'x = {:d}, y = {:d}, z = {:d}, HU = {:d}'.format(x, y, self.spinBox_z0.value(), HU)
+            ix, iy, iz = x, y, self.spinBox_z0.value()
         elif ax == self.pxz:
-            HU = self.ct.voxel[y, self.spinBox_y0.value(), x]
-            msg = 'x = {:d}, y = {:d}, z = {:d}, HU = {:d}'.format(x, self.spinBox_y0.value(), y, HU)
+            ix, iy, iz = x, self.spinBox_y0.value(), y
         else:
-            HU = self.ct.voxel[y, x, self.spinBox_x0.value()]
-            msg = 'x = {:d}, y = {:d}, z = {:d}, HU = {:d}'.format(self.spinBox_x0.value(), x, y, HU)
+            ix, iy, iz = self.spinBox_x0.value(), x, y
+        msg = 'x = {:d}, y = {:d}, z = {:d}, HU = {:d}'.format(ix, iy, iz, self.ct.voxel[iz, iy, ix])
+        if self.with_dose:
+            msg += ', dose = {:.4g}'.format(float(self.ct.dose[iz, iy, ix]))
+            if self.ct.dose_err is not None:
+                msg += ' \u00b1 {:.2g}'.format(float(self.ct.dose_err[iz, iy, ix]))
 
         self.statusBar.showMessage(msg)
 
@@ -283,84 +756,248 @@ class myApp(QMainWindow):
     def display(self, enforce_refresh=False):
         if self.hold_display_refresh and not enforce_refresh:
             return
-        
+
         self.hold_display_refresh = False
+        start = time.perf_counter()
+        with ct_profile.timer('display'):
+            if self.firstDraw:
+                self.scheduler.cancel()  # a new volume or dose supersedes any scheduled redraw
+                self.setupDisplay()
+            else:
+                self.updateDisplay()
+        self.showFrameTime(time.perf_counter() - start)
+
+
+    def showFrameTime(self, seconds):
+        now = time.perf_counter()
+        self.frame_times.append(now)
+        while now - self.frame_times[0] > 1.:
+            self.frame_times.popleft()
+        self.label_frame_time.setText('{:.1f} ms  {:d} fps  {:d} dropped'.format(
+            seconds * 1000., len(self.frame_times), self.scheduler.dropped_frames))
+
+
+    def setupDisplay(self):
+        # Build axes and artists once for a newly loaded volume or dose.  Later
+        # ticks only update image data, titles and overlays in updateDisplay().
         self.fig.clear()
         self.pxy = self.fig.add_subplot(1, 2, 1)
         self.pxz = self.fig.add_subplot(2, 2, 2)
         self.pyz = self.fig.add_subplot(2, 2, 4)
-        # if self.firstDraw:
-        #     self.pxy = self.fig.add_subplot(1, 2, 1)
-        #     self.pxz = self.fig.add_subplot(2, 2, 2)
-        #     self.pyz = self.fig.add_subplot(2, 2, 4)
-        #     self.firstDraw = False
-        # else:
-        #     self.pxy.clear()
-        #     self.pxz.clear()
-        #     self.pyz.clear()
-        #     try:  self.cb.clear()
-        #     except: pass
+        self.firstDraw = False
 
         x0 = self.spinBox_x0.value()
         y0 = self.spinBox_y0.value()
         z0 = self.spinBox_z0.value()
-        self.pxy.imshow(self.ct.voxel[z0,:,:], cmap='gray', aspect=self.ct.dy/self.ct.dx)
-        self.pxz.imshow(self.ct.voxel[:,y0,:], cmap='gray', aspect=self.ct.dz/self.ct.dx)
-        self.pyz.imshow(self.ct.voxel[:,:,x0], cmap='gray', aspect=self.ct.dz/self.ct.dy)
+        # plane images and titles are animated too: a plane change only redraws its own view
+        with ct_profile.timer('imshow'):
+            self.im_xy = self.pxy.imshow(apply_lut(self.lut, self.viewPlane(0, z0)), aspect=self.ct.dy/self.ct.dx, animated=True)
+            self.im_xz = self.pxz.imshow(apply_lut(self.lut, self.viewPlane(1, y0)), aspect=self.ct.dz/self.ct.dx, animated=True)
+            self.im_yz = self.pyz.imshow(apply_lut(self.lut, self.viewPlane(2, x0)), aspect=self.ct.dz/self.ct.dy, animated=True)
+        self.plane_axes = [self.pxy, self.pxz, self.pyz]   # views of the planes at z, y and x
+        self.plane_images = [self.im_xy, self.im_xz, self.im_yz]
+        for ax in self.plane_axes:
+            ax.title.set_animated(True)
+        self.shown_coarse = False
 
         self.pxy.set_xlabel('X')
         self.pxy.set_ylabel('Y')
-        self.pxy.set_title('Z = {:d}'.format(self.spinBox_z0.value()))
-        
         self.pxz.set_xlabel('X')
         self.pxz.set_ylabel('Z')
-        self.pxz.set_title('Y = {:d}'.format(self.spinBox_y0.value()))
-
         self.pyz.set_xlabel('Y')
         self.pyz.set_ylabel('Z')
-        self.pyz.set_title('X = {:d}'.format(self.spinBox_x0.value()))
-        
-        # draw display center lines
-        if self.checkBox_center_lines.isChecked():
-            color = 'white'
-            self.pxy.plot([0, self.ct.nx-1], [y0, y0], color=color, linestyle='--')
-            self.pxy.plot([x0, x0], [0, self.ct.ny-1], color=color, linestyle='--')
-            self.pxz.plot([0, self.ct.nx-1], [z0, z0], color=color, linestyle='--')
-            self.pxz.plot([x0, x0], [0, self.ct.nz-1], color=color, linestyle='--')
-            self.pyz.plot([0, self.ct.ny-1], [z0, z0], color=color, linestyle='--')
-            self.pyz.plot([y0, y0], [0, self.ct.nz-1], color=color, linestyle='--')
-
-        # draw cut lines
+
+        # display center lines and cut boxes are animated artists blitted over the cached background
+        color = 'white'
+        self.center_lines = [ax.plot([], [], color=color, linestyle='--', animated=True)[0]
+                             for ax in (self.pxy, self.pxy, self.pxz, self.pxz, self.pyz, self.pyz)]
         cutcol = 'cyan'
+        self.cut_lines = [ax.plot([], [], color=cutcol, linestyle=':', animated=True)[0]
+                          for ax in (self.pxy, self.pxz, self.pyz)]
+
+        self.shown_planes = (x0, y0, z0)
+        self.volume_changed = False
+        self.setTitles()
+        if self.with_dose:
+            if self.overlay is not None:
+                self.overlay.close()
+            self.overlay = dose_overlay(self.ct.dose_pct, levels=self.dose_levels)
+            with ct_profile.timer('dose_display'):
+                self.dose_images = [
+                    self.pxy.imshow(self.overlay.get(0, z0), aspect=self.ct.dy/self.ct.dx, animated=True),
+                    self.pxz.imshow(self.overlay.get(1, y0), aspect=self.ct.dz/self.ct.dx, animated=True),
+                    self.pyz.imshow(self.overlay.get(2, x0), aspect=self.ct.dz/self.ct.dy, animated=True) ]
+                self.fig.colorbar(self.overlay.mappable(), ax=self.pxy, orientation='horizontal', ticks=self.overlay.levels)
+
+        self.updateOverlays()
+        with ct_profile.timer('tight_layout'):
+            plt.tight_layout()
+        with ct_profile.timer('canvas_draw'):
+            self.canvas.draw()
+
+
+    def updateDisplay(self):
+        x0 = self.spinBox_x0.value()
+        y0 = self.spinBox_y0.value()
+        z0 = self.spinBox_z0.value()
+        # while a slider is dragged, planes come from the coarsest pyramid level; projections
+        # are cached or updated incrementally, so they stay at full resolution
+        coarse = len(self.ct.pyramid) > 0 and any(s.isSliderDown() for s in (self.hSlider_x0, self.hSlider_y0, self.hSlider_z0))
+        coarse = coarse and self.comboBox_projection.currentText() == 'Plane'
+        self.updateOverlays()
+        if (x0, y0, z0) == self.shown_planes and coarse == self.shown_coarse and not self.volume_changed:
+            self.blitOverlays()
+            return
+
+        old_x0, old_y0, old_z0 = self.shown_planes
+        if self.volume_changed or coarse != self.shown_coarse:  # volume data, window or resolution changed
+            old_x0 = old_y0 = old_z0 = -1
+            self.volume_changed = False
+        changed = [axis for axis, (new, old) in enumerate(((z0, old_z0), (y0, old_y0), (x0, old_x0))) if new != old]
+        with ct_profile.timer('imshow'):
+            if z0 != old_z0:
+                self.setPlaneImage(self.im_xy, 0, z0, coarse)
+            if y0 != old_y0:
+                self.setPlaneImage(self.im_xz, 1, y0, coarse)
+            if x0 != old_x0:
+                self.setPlaneImage(self.im_yz, 2, x0, coarse)
+        self.shown_planes = (x0, y0, z0)
+        self.shown_coarse = coarse
+        self.setTitles()
+        if self.with_dose:
+            with ct_profile.timer('dose_display'):
+                if z0 != old_z0:
+                    self.dose_images[0].set_data(self.overlay.get(0, z0))
+                if y0 != old_y0:
+                    self.dose_images[1].set_data(self.overlay.get(1, y0))
+                if x0 != old_x0:
+                    self.dose_images[2].set_data(self.overlay.get(2, x0))
+                self.overlay.prefetch({0: z0, 1: y0, 2: x0})
+        self.blitOverlays(changed)
+
+
+    def setPlaneImage(self, image, axis, index, coarse=False):
+        # axis 0, 1, 2 are the planes at z = index, y = index and x = index
+        key = [slice(None)] * 3
+        if not coarse:
+            nx, ny, nz = self.ct.nx, self.ct.ny, self.ct.nz
+            image.set_data(apply_lut(self.lut, self.viewPlane(axis, index)))
+            image.set_extent([[-0.5, nx-0.5, ny-0.5, -0.5], [-0.5, nx-0.5, nz-0.5, -0.5], [-0.5, ny-0.5, nz-0.5, -0.5]][axis])
+            return
+
+        level = self.ct.pyramid[-1]
+        n = (level.nx, level.ny, level.nz)
+        a = 2 - axis   # index of the sliced axis in (x, y, z) order
+        key[axis] = min(max(int((index + 0.5 - level.origin[a]) / level.ratio[a]), 0), n[a] - 1)
+        lo = level.origin - 0.5
+        hi = level.origin + level.ratio * n - 0.5
+        h, v = [(0, 1), (0, 2), (1, 2)][axis]   # horizontal and vertical axes of the plane
+        image.set_data(apply_lut(self.lut, level.voxel[tuple(key)]))
+        image.set_extent([lo[h], hi[h], hi[v], lo[v]])
+
+
+    def viewPlane(self, axis, index):
+        # the plane, projection or thick slab selected by the View and Slab controls
+        mode = self.comboBox_projection.currentText()
+        with ct_profile.timer('projection' if mode != 'Plane' else 'plane'):
+            return self.ct.view_plane(axis, index, mode, self.spinBox_slab.value())
+
+
+    def slider_released(self):
+        self.scheduler.request(True)   # swap the coarse planes for full resolution
+
+
+    def setTitles(self):
+        x0, y0, z0 = self.shown_planes
+        mode = self.comboBox_projection.currentText()
+        thickness = self.spinBox_slab.value()
+        for ax, name, index in ((self.pxy, 'Z', z0), (self.pxz, 'Y', y0), (self.pyz, 'X', x0)):
+            if mode == 'Plane':
+                ax.set_title('{:} = {:d}'.format(name, index))
+            elif thickness == 0:
+                ax.set_title('{:} along {:}'.format(mode, name))
+            else:
+                ax.set_title('{:} {:} = {:d} ({:d} slices)'.format(mode, name, index, thickness))
+
+
+    def updateOverlays(self):
+        x0 = self.spinBox_x0.value()
+        y0 = self.spinBox_y0.value()
+        z0 = self.spinBox_z0.value()
+        nx, ny, nz = self.ct.nx, self.ct.ny, self.ct.nz
+        show = self.checkBox_center_lines.isChecked()
+        center = [([0, nx-1], [y0, y0]), ([x0, x0], [0, ny-1]),
+                  ([0, nx-1], [z0, z0]), ([x0, x0], [0, nz-1]),
+                  ([0, ny-1], [z0, z0]), ([y0, y0], [0, nz-1])]
+        for line, (xs, ys) in zip(self.center_lines, center):
+            line.set_data(xs, ys)
+            line.set_visible(show)
+
         x1 = self.spinBox_x1.value()
         x2 = self.spinBox_x2.value()
         y1 = self.spinBox_y1.value()
         y2 = self.spinBox_y2.value()
         z1 = self.spinBox_z1.value()
         z2 = self.spinBox_z2.value()
-        self.pxy.plot([x1, x2], [y1, y1], color=cutcol, linestyle=':')
-        self.pxy.plot([x1, x2], [y2, y2], color=cutcol, linestyle=':')
-        self.pxy.plot([x1, x1], [y1, y2], color=cutcol, linestyle=':')
-        self.pxy.plot([x2, x2], [y1, y2], color=cutcol, linestyle=':')
-        self.pxz.plot([x1, x2], [z1, z1], color=cutcol, linestyle=':')
-        self.pxz.plot([x1, x2], [z2, z2], color=cutcol, linestyle=':')
-        self.pxz.plot([x1, x1], [z1, z2], color=cutcol, linestyle=':')
-        self.pxz.plot([x2, x2], [z1, z2], color=cutcol, linestyle=':')
-        self.pyz.plot([y1, y2], [z1, z1], color=cutcol, linestyle=':')
-        self.pyz.plot([y1, y2], [z2, z2], color=cutcol, linestyle=':')
-        self.pyz.plot([y1, y1], [z1, z2], color=cutcol, linestyle=':')
-        self.pyz.plot([y2, y2], [z1, z2], color=cutcol, linestyle=':')
-
-        # draw dose when exists
+        for line, (a1, a2, b1, b2) in zip(self.cut_lines, [(x1, x2, y1, y2), (x1, x2, z1, z2), (y1, y2, z1, z2)]):
+            line.set_data([a1, a2, a2, a1, a1], [b1, b1, b2, b2, b1])
+
+
+    def drawOverlays(self, axis):
+        # center lines and cut box of the view of plane axis
+        for line in self.center_lines[2*axis : 2*axis+2] + self.cut_lines[axis : axis+1]:
+            self.fig.draw_artist(line)
+
+
+    def drawPlane(self, axis):
+        # plane image, dose overlay and title of one view over its static background; the
+        # result is kept so that moving only the lines does not redraw the image
+        self.fig.draw_artist(self.plane_images[axis])
         if self.with_dose:
-            levels = [0.1, 1, 2, 5, 10, 20, 50, 100]
-            im = self.pxy.contourf(self.ct.dose_pct[z0,:,:], levels=levels, norm=LogNorm(), cmap='jet', alpha=0.5)
-            self.fig.colorbar(im, ax=self.pxy, orientation='horizontal')
-            self.pxz.contourf(self.ct.dose_pct[:,y0,:], levels=levels, norm=LogNorm(), cmap='jet', alpha=0.5)
-            self.pyz.contourf(self.ct.dose_pct[:,:,x0], levels=levels, norm=LogNorm(), cmap='jet', alpha=0.5)
-
-        plt.tight_layout()
-        self.canvas.draw()
+            self.fig.draw_artist(self.dose_images[axis])
+        self.fig.draw_artist(self.plane_axes[axis].title)
+        self.plane_backgrounds[axis] = self.canvas.copy_from_bbox(self.regions[axis])
+        self.drawOverlays(axis)
+
+
+    def blitRegions(self):
+        # canvas area of each view with its title: the left column for the z plane, and the
+        # right column split at the bottom of the y view
+        fig = self.fig.bbox
+        split = 0.5 * (self.pxy.bbox.x1 + min(self.pxz.bbox.x0, self.pyz.bbox.x0))
+        middle = self.pxz.bbox.y0
+        return [Bbox.from_extents(fig.x0, fig.y0, split, fig.y1),
+                Bbox.from_extents(split, middle, fig.x1, fig.y1),
+                Bbox.from_extents(split, fig.y0, fig.x1, middle)]
+
+
+    def blitOverlays(self, changed=()):
+        # redraw the views whose planes are in changed and the lines of all views
+        if self.backgrounds is None:
+            with ct_profile.timer('canvas_draw'):
+                self.canvas.draw()
+            return
+        with ct_profile.timer('overlay_blit' if not changed else 'plane_blit'):
+            for axis in range(3):
+                if axis in changed:
+                    self.canvas.restore_region(self.backgrounds[axis])
+                    self.drawPlane(axis)
+                else:
+                    self.canvas.restore_region(self.plane_backgrounds[axis])
+                    self.drawOverlays(axis)
+                self.canvas.blit(self.regions[axis])
+
+
+    def canvas_drawn(self, event):
+        # cache the static parts of each view after a full draw, then put the animated
+        # planes, titles and lines back on top
+        if self.firstDraw:
+            return
+        self.regions = self.blitRegions()
+        self.backgrounds = [self.canvas.copy_from_bbox(r) for r in self.regions]
+        self.plane_backgrounds = [None] * 3
+        for axis in range(3):
+            self.drawPlane(axis)
 
 
 if __name__ == "__main__":
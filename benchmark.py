@@ -0,0 +1,261 @@
+# Benchmark ct_image and the GUI on synthetic CT phantoms
+#
+# Usage: python benchmark.py [--size small|medium|large] [--out results.json] [--compare baseline.json]
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+from ct_image import ct_img
+
+# (nx, ny, nz) and (dx, dy, dz) in mm
+SIZES = {
+    'small': ((128, 128, 128), (2.0, 2.0, 2.0)),
+    'medium': ((512, 512, 512), (0.8, 0.8, 1.0)),
+    'large': ((1024, 1024, 1500), (0.5, 0.5, 0.5)) }
+
+SLAB = 16   # slices generated and written at a time, so large phantoms never sit in memory whole
+PYDICOM_3 = int(pydicom.__version__.split('.')[0]) >= 3   # save_as(enforce_file_format=...) is new in 3.0
+
+
+def phantom_slab(z1, z2, shape, spacing, seed=0):
+    # CT numbers (HU) of slices z1 <= z < z2: air, an elliptic body of soft tissue,
+    # two lungs, a spine and a ring of ribs, with Gaussian noise
+    nx, ny, nz = shape
+    dx, dy, dz = spacing
+    rng = np.random.default_rng(seed + z1)
+    z = (np.arange(z1, z2) - nz / 2.) * dz
+    y = (np.arange(ny) - ny / 2.) * dy
+    x = (np.arange(nx) - nx / 2.) * dx
+    Z, Y, X = np.meshgrid(z, y, x, indexing='ij')
+    a, b = 0.42 * nx * dx, 0.32 * ny * dy   # body half axes
+
+    hu = np.full(Z.shape, -1000, dtype=np.float32)
+    body = (X / a)**2 + (Y / b)**2 < 1
+    hu[body] = 40
+    lung = ((np.abs(X) - 0.45 * a) / (0.3 * a))**2 + (Y / (0.6 * b))**2 + (Z / (0.35 * nz * dz))**2 < 1
+    hu[lung] = -850
+    ring = (X / (0.9 * a))**2 + (Y / (0.9 * b))**2
+    ribs = (ring > 0.85) & (ring < 1) & (np.cos(Z / 12.) > 0.6)
+    hu[ribs] = 900
+    spine = X**2 + (Y - 0.65 * b)**2 < (0.1 * a)**2
+    hu[spine] = 1200
+    hu += rng.normal(0, 20, hu.shape).astype(np.float32)
+    return np.clip(np.rint(hu), -1024, 3071).astype(np.int16)
+
+
+def write_phantom_img(img_file, shape, spacing, seed=0):
+    nx, ny, nz = shape
+    with open(img_file, 'wb') as f:
+        f.write(struct.pack('iii', nx, ny, nz))
+        f.write(struct.pack('fff', *spacing))
+        for z in range(0, nz, SLAB):
+            phantom_slab(z, min(z + SLAB, nz), shape, spacing, seed).tofile(f)
+
+
+def write_phantom_dicom(ct_dir, shape, spacing, seed=0):
+    # one uncompressed slice per file, stored as HU + 1024 with RescaleIntercept = -1024
+    nx, ny, nz = shape
+    os.makedirs(ct_dir, exist_ok=True)
+    for z1 in range(0, nz, SLAB):
+        slab = phantom_slab(z1, min(z1 + SLAB, nz), shape, spacing, seed)
+        for k in range(slab.shape[0]):
+            z = z1 + k
+            meta = FileMetaDataset()
+            meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+            meta.MediaStorageSOPInstanceUID = generate_uid()
+            ds = Dataset()
+            ds.file_meta = meta
+            ds.Rows, ds.Columns = ny, nx
+            ds.PixelSpacing = [spacing[0], spacing[1]]
+            ds.SliceThickness = spacing[2]
+            ds.SliceLocation = (z - nz / 2.) * spacing[2]
+            ds.RescaleSlope = 1
+            ds.RescaleIntercept = -1024
+            ds.RescaleType = 'HU'
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = 'MONOCHROME2'
+            ds.BitsAllocated = ds.BitsStored = 16
+            ds.HighBit = 15
+            ds.PixelRepresentation = 0
+            ds.PixelData = (slab[k].astype(np.int32) + 1024).astype(np.uint16).tobytes()
+            dcm_file = os.path.join(ct_dir, 'CT{:05d}.dcm'.format(z))
+            if PYDICOM_3:
+                ds.save_as(dcm_file, enforce_file_format=True)
+            else:  # older pydicom takes the encoding from the dataset
+                ds.is_little_endian, ds.is_implicit_VR = True, False
+                ds.save_as(dcm_file, write_like_original=False)
+
+
+def write_phantom_dose(dose_file, shape, spacing, energy=2.0):
+    # a beam along y through the center, stored for the middle half of x and z
+    nx, ny, nz = shape
+    dx, dy, dz = spacing
+    dose_x, dose_z = nx // 2, nz // 2
+    x1, x2 = nx // 4, nx * 3 // 4 - 1
+    z1, z2 = nz // 4, nz * 3 // 4 - 1
+    sigma = 0.05 * nx * dx
+    with open(dose_file, 'wb') as f:
+        f.write(struct.pack('iii', nx, ny, nz))
+        f.write(struct.pack('fff', dx, dy, dz))
+        f.write(struct.pack('iif', dose_x, dose_z, energy))
+        f.write(struct.pack('ii', x1, x2))
+        f.write(struct.pack('ii', z1, z2))
+        x = (np.arange(x1, x2 + 1) - dose_x) * dx
+        y = np.arange(ny) * dy
+        for z in range(z1, z2 + 1, SLAB):
+            zz = (np.arange(z, min(z + SLAB, z2 + 1)) - dose_z) * dz
+            Z, Y, X = np.meshgrid(zz, y, x, indexing='ij')
+            dose = np.exp(-(X**2 + Z**2) / (2 * sigma**2)) * np.exp(-Y / (0.5 * ny * dy))
+            dose.astype(np.float32).tofile(f)
+
+
+def measure(func, *args, **kwargs):
+    # run func once and return (result, seconds, peak traced memory in MB)
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 2.**20
+
+
+def load_uncached(ct_dir):
+    # dicom2img without the header index of an earlier open
+    for f in os.listdir(ct_dir):
+        if f.startswith('.ct_index'):
+            os.remove(os.path.join(ct_dir, f))
+    return ct_img(ct_dir)
+
+
+def render_frames(img_file, dose_file=None, frames=20):
+    # mean time of off-screen myApp.display() updates while stepping through z
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    app = QApplication.instance() or QApplication(sys.argv)
+    import CT_gui
+    window = CT_gui.myApp()
+    window.img_filename = img_file
+    window.folder = os.path.dirname(img_file)
+    window.fileReady(ct_img(img_file, mmap=True))
+    if dose_file is not None:
+        window.ct.read_dose(dose_file, mmap=True)
+        window.doseReady(dose_file)
+    z0 = window.spinBox_z0.value()
+    t0 = time.perf_counter()
+    for i in range(frames):
+        window.spinBox_z0.setValue((z0 + i + 1) % window.ct.nz)
+        window.scheduler.flush()
+    seconds = (time.perf_counter() - t0) / frames
+    window.close()
+    return seconds
+
+
+def run_benchmarks(size='small', workdir='bench_data', gui=True, repeat=1, seed=0):
+    shape, spacing = SIZES[size]
+    nx, ny, nz = shape
+    os.makedirs(workdir, exist_ok=True)
+    ct_dir = os.path.join(workdir, '{:}_dcm'.format(size))
+    img_file = os.path.join(workdir, '{:}.img'.format(size))
+    dose_file = os.path.join(workdir, '{:}.dose'.format(size))
+    crop_file = os.path.join(workdir, '{:}_crop.img'.format(size))
+
+    if not os.path.isdir(ct_dir):
+        print('Generating {:} DICOM series ...'.format(size))
+        write_phantom_dicom(ct_dir, shape, spacing, seed)
+    if not os.path.isfile(img_file):
+        write_phantom_img(img_file, shape, spacing, seed)
+    if not os.path.isfile(dose_file):
+        write_phantom_dose(dose_file, shape, spacing)
+
+    results = {}
+    def record(name, func, *args, **kwargs):
+        # best time and largest peak memory over the repeats
+        runs = [measure(func, *args, **kwargs) for i in range(repeat)]
+        seconds = min(run[1] for run in runs)
+        peak = max(run[2] for run in runs)
+        results[name] = {'seconds': seconds, 'peak_mb': peak}
+        print('{:24s} {:9.3f} s {:10.1f} MB'.format(name, seconds, peak))
+        return runs[-1][0]
+
+    record('dicom2img', load_uncached, ct_dir)
+    record('dicom2img_indexed', ct_img, ct_dir)
+    ct = record('read_img', ct_img, img_file)
+    record('read_img_mmap', ct_img, img_file, mmap=True)
+    record('read_dose', ct.read_dose, dose_file)
+    record('read_dose_mmap', lambda: ct.read_dose(dose_file, mmap=True) or ct.dose_pct[nz // 2])
+    record('resample_2x', ct.resample, ct.dx * 2, ct.dy * 2, ct.dz * 2, workers=os.cpu_count())
+    box = (nx // 4, nx * 3 // 4, ny // 4, ny * 3 // 4, nz // 4, nz * 3 // 4)
+    record('export_crop', ct.write_img, crop_file, box=box)
+    record('export_crop_v2', ct.write_img, crop_file, box=box, version=2)
+    record('dvh', lambda: ct.dvh_cache.clear() or ct.dvh())
+    record('dvh_hu_mask', lambda: ct.dvh_cache.clear() or ct.mask_cache.clear() or ct.dvh(hu_range=(-200, 300)))
+    if gui:
+        try:
+            results['render_frame'] = {'seconds': min(render_frames(img_file) for i in range(repeat))}
+            results['render_frame_dose'] = {'seconds': min(render_frames(img_file, dose_file) for i in range(repeat))}
+            print('{:24s} {:9.3f} s'.format('render_frame', results['render_frame']['seconds']))
+            print('{:24s} {:9.3f} s'.format('render_frame_dose', results['render_frame_dose']['seconds']))
+        except ImportError as e:
+            print('GUI renders skipped: {:}'.format(e))
+    return {'size': size, 'shape': shape, 'spacing': spacing, 'repeat': repeat,
+            'machine': {'python': platform.python_version(), 'numpy': np.__version__, 'pydicom': pydicom.__version__,
+                        'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+            'results': results}
+
+
+def compare(current, baseline, tolerance=0.2):
+    # print the time ratio to the baseline; return names slower by more than tolerance
+    slower = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        ratio = result['seconds'] / max(baseline['results'][name]['seconds'], 1e-9)
+        flag = ''
+        if ratio > 1 + tolerance:
+            slower.append(name)
+            flag = '  <-- slower'
+        print('{:24s} {:6.2f}x baseline{:}'.format(name, ratio, flag))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark ct_image and the GUI on synthetic phantoms.')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--workdir', default='bench_data', help='folder for the generated phantoms')
+    parser.add_argument('--out', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON file from an earlier run')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per benchmark; the best time is kept')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--no-gui', action='store_true', help='skip the off-screen display benchmarks')
+    parser.add_argument('--clean', action='store_true', help='remove the generated phantoms afterwards')
+    args = parser.parse_args(argv)
+
+    current = run_benchmarks(args.size, args.workdir, gui=not args.no_gui, repeat=args.repeat)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(current, f, indent=2)
+    if args.clean:
+        shutil.rmtree(args.workdir)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('size') != args.size:
+            print('Baseline is for size {:}, not {:}'.format(baseline.get('size'), args.size))
+            return 1
+        return 1 if compare(current, baseline, args.tolerance) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
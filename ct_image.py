@@ -1,51 +1,961 @@
 import numpy as np
 import os
+import json
+import zlib
 import struct
+import hashlib
+import bisect
+import threading
 import pydicom
+import ct_profile
 import matplotlib.pyplot as plt
 from matplotlib.ticker import NullFormatter
-from matplotlib.colors import LogNorm
+from matplotlib.colors import LogNorm, BoundaryNorm, ListedColormap
+from matplotlib.cm import ScalarMappable
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+DICOM_INDEX_NAME = '.ct_index.json'
+DICOM_INDEX_VERSION = 1
+
+
+def _rescale_hu(pixels, slope, intercept):
+    # rescale stored pixel values to HU as int16
+    if slope == 1.0 and intercept == int(intercept):
+        hu = pixels.astype(np.int32) + int(intercept)
+    else:
+        hu = np.rint(pixels * np.float32(slope) + np.float32(intercept))
+    return np.clip(hu, -32768, 32767).astype(np.int16)
+
+
+@ct_profile.timed('pixel_decode')
+def _decode_dicom_slice(dcm_file, raw=None):
+    # decode one slice; raw = (offset, dtype, rows, columns, slope, intercept) reads
+    # uncompressed pixel data straight from the file without parsing the header again
+    if raw is not None:
+        offset, dtype, rows, columns, slope, intercept = raw
+        pixels = np.fromfile(dcm_file, dtype=dtype, count=rows*columns, offset=offset).reshape(rows, columns)
+        return _rescale_hu(pixels, slope, intercept)
+    ds = pydicom.dcmread(dcm_file)
+    slope = float(getattr(ds, 'RescaleSlope', 1.0))
+    intercept = float(getattr(ds, 'RescaleIntercept', 0.0))
+    return _rescale_hu(ds.pixel_array, slope, intercept)
+
+
+def _decode_dicom_into(voxel, i, dcm_file, raw=None):
+    voxel[i,:,:] = _decode_dicom_slice(dcm_file, raw)
+
+
+def _raw_pixel_info(ds):
+    # (offset, dtype) of uncompressed little-endian 16-bit pixel data, or None if
+    # the slice has to go through pydicom's decoder
+    try:
+        elem = ds.get_item('PixelData', keep_deferred=True)
+        syntax = ds.file_meta.TransferSyntaxUID
+    except (TypeError, AttributeError, KeyError):  # older pydicom or no file meta
+        return None
+    if getattr(elem, 'value_tell', None) is None or syntax.is_compressed or not syntax.is_little_endian \
+            or getattr(syntax, 'is_deflated', False):
+        return None
+    if ds.BitsAllocated != 16 or ds.BitsStored != 16 or ds.get('SamplesPerPixel', 1) != 1 \
+            or elem.length != ds.Rows * ds.Columns * 2:
+        return None
+    return elem.value_tell, '<i2' if ds.PixelRepresentation == 1 else '<u2'
+
+
+def _dicom_slice_info(dcm_file):
+    # header of one slice without its pixel data: the index entry and the dataset
+    ds = pydicom.dcmread(dcm_file, defer_size=1024)  # pixel data is skipped, not read
+    raw = _raw_pixel_info(ds)
+    info = {'file': os.path.basename(dcm_file), 'z': float(ds.SliceLocation),
+            'offset': None if raw is None else raw[0], 'dtype': None if raw is None else raw[1],
+            'slope': float(getattr(ds, 'RescaleSlope', 1.0)),
+            'intercept': float(getattr(ds, 'RescaleIntercept', 0.0))}
+    return info, ds
+
+
+def _dicom_geometry(ds):
+    return {'nx': int(ds.Columns), 'ny': int(ds.Rows),
+            'dx': float(ds.PixelSpacing[0]), 'dy': float(ds.PixelSpacing[1]), 'dz': float(ds.SliceThickness),
+            'rescale_slope': float(getattr(ds, 'RescaleSlope', 1.0)),
+            'rescale_intercept': float(getattr(ds, 'RescaleIntercept', 0.0)),
+            'rescale_type': '{:}'.format(ds.RescaleType) if 'RescaleType' in ds else 'Not Defined'}
+
+
+@ct_profile.timed('file_discovery')
+def dicom_file_stats(ct_dir):
+    # file name -> [size, mtime_ns] of the .dcm files, used to validate a cached index
+    stats = {}
+    for f in os.listdir(ct_dir):
+        if f.endswith('.dcm'):
+            st = os.stat(os.path.join(ct_dir, f))
+            stats[f] = [st.st_size, st.st_mtime_ns]
+    return stats
+
+
+def dicom_index_paths(ct_dir):
+    # the index lives in the series folder, or in the user cache when the folder is read-only
+    key = hashlib.sha1(os.path.abspath(ct_dir).encode('utf-8')).hexdigest()
+    cache = os.path.join(os.path.expanduser('~'), '.cache', 'ct_dicom_gui', key + '.json')
+    return [os.path.join(ct_dir, DICOM_INDEX_NAME), cache]
+
+
+@ct_profile.timed('header_index_load')
+def load_dicom_index(ct_dir, stats):
+    for path in dicom_index_paths(ct_dir):
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if index.get('version') == DICOM_INDEX_VERSION and index.get('files') == stats:
+            return index
+    return None
+
+
+def save_dicom_index(ct_dir, index):
+    for path in dicom_index_paths(ct_dir):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(index, f)
+            return path
+        except OSError:
+            continue
+    return None
+
+
+def bin_weights(nnx, ndx, nx, dx):
+    # Volume-average weights along one axis, following bin_ratio() in img_resize.c.
+    # Returns a (nnx, nx) matrix whose row i holds the fraction of each original
+    # voxel that falls into new voxel i.
+    ndx = np.float32(ndx)
+    dx = np.float32(dx)
+    width_ratio = int(ndx / dx) + 2
+    x_loc = np.array([np.float32(ix - nnx // 2) * ndx / dx + np.float32(nx // 2) for ix in range(nnx + 1)], dtype=np.float32)
+
+    weights = np.zeros((nnx, nx), dtype=np.float64)
+    for i in range(nnx):
+        x0 = x_loc[i]
+        x1 = x_loc[i + 1]
+        i0 = int(x0)
+        i1 = int(x1)
+        if i1 < x1:
+            i1 += 1
+        idx = np.zeros(width_ratio, dtype=np.int64)
+        ratio = np.ones(width_ratio, dtype=np.float32)
+        if i1 - i0 == width_ratio:
+            ratio[width_ratio - 1] = x1 - i1 + 1
+        elif i1 - i0 == width_ratio - 1:
+            ratio[width_ratio - 2] = x1 - i1 + 1
+            ratio[width_ratio - 1] = 0.
+        elif i1 - i0 == width_ratio - 2:
+            ratio[width_ratio - 3] = x1 - i1 + 1
+            ratio[width_ratio - 2] = 0.
+            ratio[width_ratio - 1] = 0.
+        ratio[0] = i0 + 1 - x0
+        idx[:i1 - i0] = np.arange(i0, i1)
+        np.add.at(weights[i], idx, ratio)
+    return weights
+
+
+# window/level presets as (level, width) in HU
+WINDOW_PRESETS = {
+    'Wide': (1000, 4000),
+    'Lung': (-600, 1500),
+    'Soft Tissue': (40, 400),
+    'Bone': (400, 1800) }
+
+
+def window_lut(level, width, cmap='gray'):
+    # 65536-entry RGBA table indexed by int16 values viewed as uint16, so a slice is
+    # windowed and colormapped in one lookup: window_lut(...)[voxel.view(np.uint16)]
+    hu = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.float32)
+    gray = np.clip((hu - (level - width / 2.)) * (255. / width), 0, 255).astype(np.uint8)
+    colors = plt.get_cmap(cmap)(np.arange(256), bytes=True)
+    return colors[gray]
+
+
+def apply_lut(lut, img):
+    return lut[img.view(np.uint16)]
+
+
+# piecewise-linear HU to mass density (g/cm3) calibration, held constant beyond the end points
+HU_DENSITY_CALIBRATION = [
+    (-1000, 0.00121), (-98, 0.93), (14, 1.03), (23, 1.031), (100, 1.119), (1600, 1.96), (3000, 2.8) ]
+
+# material IDs by HU range: material i covers [lower HU of i, lower HU of i+1)
+HU_MATERIALS = [
+    (-32768, 'air'), (-950, 'lung'), (-120, 'adipose'), (-20, 'soft tissue'), (150, 'bone'), (3000, 'metal') ]
+
+
+def hu_conversion_luts(calibration=HU_DENSITY_CALIBRATION, materials=HU_MATERIALS):
+    # 65536-entry density (float32) and material ID (int16) tables, indexed as window_lut
+    hu_points, densities = zip(*calibration)
+    lower_hu = [m[0] for m in materials]
+    if np.any(np.diff(hu_points) <= 0) or np.any(np.diff(lower_hu) <= 0):
+        raise Exception('HU values of the calibration and material table must be increasing')
+    hu = np.arange(65536, dtype=np.uint16).view(np.int16)
+    density = np.interp(hu, hu_points, densities).astype(np.float32)
+    material = np.maximum(np.searchsorted(lower_hu, hu, side='right') - 1, 0).astype(np.int16)
+    return density, material
+
+
+def read_hu_conversion(json_file):
+    # {"calibration": [[HU, density], ...], "materials": [[lower HU, name], ...]}; a missing
+    # key keeps the default table
+    with open(json_file) as f:
+        conversion = json.load(f)
+    return hu_conversion_luts(conversion.get('calibration', HU_DENSITY_CALIBRATION),
+                              conversion.get('materials', HU_MATERIALS))
+
+
+def hu_conversion_files(img_file):
+    # density and material volumes written next to an .img: ct.img -> ct.density, ct.material
+    base = img_file[:-4] if img_file.endswith('.img') else img_file
+    return base + '.density', base + '.material'
+
+
+IMG_V2_MAGIC = b'CTIMGv2\0'
+IMG_V2_HEADER = '<8siiifffiiii'   # magic, nx, ny, nz, dx, dy, dz, chunk z, y, x, codec
+IMG_V2_CODEC_ZLIB = 1             # zlib over the int16 bytes split into low and high byte planes
+IMG_V2_CHUNKS = (16, 64, 64)
+
+
+def _compress_chunk(block, level=6):
+    planes = np.ascontiguousarray(block, dtype='<i2').view(np.uint8).reshape(-1, 2).T
+    return zlib.compress(planes.tobytes(), level)
+
+
+def _decompress_chunk(data, shape):
+    planes = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(2, -1)
+    return np.ascontiguousarray(planes.T).view('<i2').reshape(shape)
+
+
+class chunked_volume:
+    # Read-only (nz, ny, nx) int16 volume in a v2 .img file.  Indexing with ints and
+    # slices decompresses only the chunks it touches; recent chunks are kept in an LRU cache.
+    def __init__(self, img_file, cache_size=256):
+        # the handle stays open so the chunks remain readable after the path is replaced by write_img
+        self.file = img_file
+        self.handle = f = open(img_file, 'rb')
+        header = struct.unpack(IMG_V2_HEADER, f.read(struct.calcsize(IMG_V2_HEADER)))
+        magic, nx, ny, nz, dx, dy, dz, cz, cy, cx, codec = header
+        if magic != IMG_V2_MAGIC or codec != IMG_V2_CODEC_ZLIB:
+            f.close()
+            raise Exception('Unsupported img format in {:}'.format(img_file))
+        self.shape = (nz, ny, nx)
+        self.voxel_size = (np.float32(dx), np.float32(dy), np.float32(dz))
+        self.chunks = (cz, cy, cx)
+        self.grid = (-(-nz // cz), -(-ny // cy), -(-nx // cx))
+        index = np.frombuffer(f.read(int(np.prod(self.grid)) * 16), dtype='<u8').reshape(self.grid + (2,))
+        self.offsets = index[..., 0]
+        self.lengths = index[..., 1]
+        self.ndim = 3
+        self.dtype = np.dtype(np.int16)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def chunk(self, iz, iy, ix):
+        key = (iz, iy, ix)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            self.handle.seek(int(self.offsets[key]))
+            data = self.handle.read(int(self.lengths[key]))
+        shape = tuple(min(c, n - i * c) for c, n, i in zip(self.chunks, self.shape, key))
+        block = _decompress_chunk(data, shape)
+        with self.lock:
+            self.cache[key] = block
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return block
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def close(self):
+        self.handle.close()
+
+    def __del__(self):
+        if hasattr(self, 'handle'):
+            self.handle.close()
+
+    def read_region(self, lo, hi):
+        # dense copy of voxels lo[a] <= i < hi[a] on each axis
+        out = np.empty([h - l for l, h in zip(lo, hi)], dtype=np.int16)
+        ranges = [range(l // c, (h - 1) // c + 1) for l, h, c in zip(lo, hi, self.chunks)]
+        for iz in ranges[0]:
+            for iy in ranges[1]:
+                for ix in ranges[2]:
+                    block = self.chunk(iz, iy, ix)
+                    src, dst = [], []
+                    for i, c, l, h, n in zip((iz, iy, ix), self.chunks, lo, hi, block.shape):
+                        a, b = max(l, i * c), min(h, i * c + n)
+                        src.append(slice(a - i * c, b - i * c))
+                        dst.append(slice(a - l, b - l))
+                    out[tuple(dst)] = block[tuple(src)]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        lo, hi, sel = [], [], []
+        for k, n in zip(key, self.shape):
+            idx = np.arange(n)[k]
+            if np.ndim(idx) == 0:
+                lo.append(int(idx))
+                hi.append(int(idx) + 1)
+                sel.append(0)
+            elif len(idx) == 0:
+                return np.zeros([len(np.arange(m)[q]) for q, m in zip(key, self.shape) if np.ndim(np.arange(m)[q])], dtype=np.int16)
+            else:
+                a, b = int(idx.min()), int(idx.max()) + 1
+                step = int(idx[1] - idx[0]) if len(idx) > 1 else 1
+                first, last = int(idx[0]) - a, int(idx[-1]) - a
+                lo.append(a)
+                hi.append(b)
+                sel.append(slice(first, last + 1 if step > 0 else (last - 1 if last > 0 else None), step))
+        out = self.read_region(lo, hi)[tuple(sel)]
+        return out[()] if out.ndim == 0 else out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :, :]
+        return out if dtype is None else out.astype(dtype)
+
+
+DOSE_HEADER_SIZE = 52   # 24-byte img header + dose position/energy (12) + x range (8) + z range (8)
+
+
+def matching_err_files(dose_files):
+    # the .err file next to each dose file (ct.dose -> ct.err), or None unless all exist
+    err_files = [os.path.splitext(f)[0] + '.err' for f in dose_files]
+    return err_files if all(os.path.isfile(f) for f in err_files) else None
+
+
+class dose_volume:
+    # Full-size (nz, ny, nx) view of a dose file that only stores the sub-block
+    # z0..z1, x0..x1.  Indexing with ints and slices returns zero-padded arrays,
+    # so slices can be taken exactly as from a dense array.
+    def __init__(self, block, shape, x0, z0, percent=False):
+        self.block = block
+        self.shape = tuple(shape)
+        self.ndim = 3
+        self.dtype = np.dtype(np.float32)
+        self.x0 = x0
+        self.z0 = z0
+        self.percent = percent
+        self._max = None
+
+    def block_max(self, callback=None):
+        # callback(done, total) is called after each chunk of slices; returning False stops
+        # the scan and block_max returns None
+        if self._max is None:
+            with ct_profile.timer('dose_normalize'):
+                m = 0.
+                nz = self.block.shape[0]
+                for z in range(0, nz, 16):  # chunked so a mapped block is never copied whole
+                    m = max(m, float(self.block[z:z+16].max()))
+                    if callback is not None and callback(min(z+16, nz), nz) is False:
+                        return None
+                self._max = m
+        return self._max
+
+    def max(self):
+        return self.block_max() * self.scale
+
+    @property
+    def scale(self):
+        if not self.percent:
+            return 1.
+        m = self.block_max()
+        return 100. / m if m > 0 else 0.
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        out_shape, src, dst = [], [], []
+        lows = (self.z0, 0, self.x0)
+        for k, n, lo, nb in zip(key, self.shape, lows, self.block.shape):
+            idx = np.arange(n)[k]
+            if np.ndim(idx) == 0:
+                if not lo <= idx < lo + nb:
+                    src = None
+                elif src is not None:
+                    src.append(int(idx) - lo)
+                continue
+            out_shape.append(len(idx))
+            inside = np.nonzero((idx >= lo) & (idx < lo + nb))[0]
+            if len(inside) == 0:
+                src = None
+            if src is None:
+                continue
+            step = int(idx[1] - idx[0]) if len(idx) > 1 else 1
+            first, last = int(idx[inside[0]]) - lo, int(idx[inside[-1]]) - lo
+            stop = last + 1 if step > 0 else (last - 1 if last > 0 else None)
+            src.append(slice(first, stop, step))
+            dst.append(slice(inside[0], inside[-1] + 1))
+        out = np.zeros(out_shape, dtype=np.float32)
+        if src is not None:
+            out[tuple(dst)] = self.block[tuple(src)] * np.float32(self.scale)
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        out = self[:, :, :]
+        return out if dtype is None else out.astype(dtype)
+
+
+DOSE_LEVELS = [0.1, 1, 2, 5, 10, 20, 50, 100]
+
+
+class dose_overlay:
+    # Pre-colored RGBA dose overlays, one per (axis, index) plane of dose_pct, kept
+    # in a bounded LRU cache.  Band colors follow contourf(levels, norm=LogNorm()):
+    # values in (levels[i], levels[i+1]] get the color of the band midpoint.
+    # axis 0 is dose_pct[i,:,:], axis 1 is dose_pct[:,i,:] and axis 2 is dose_pct[:,:,i].
+    def __init__(self, dose_pct, levels=DOSE_LEVELS, cmap='jet', alpha=0.5, maxsize=64):
+        self.dose_pct = dose_pct
+        self.levels = np.array(sorted(levels), dtype=np.float32)
+        self.maxsize = maxsize
+        mid = 0.5 * (self.levels[:-1] + self.levels[1:])
+        norm = LogNorm(vmin=self.levels[0], vmax=self.levels[-1])
+        self.band_colors = plt.get_cmap(cmap)(norm(mid))
+        self.band_colors[:, 3] = alpha
+        # row 0 is below the lowest level and the last row above the highest; both transparent
+        self.colors = np.zeros((len(self.levels) + 1, 4), dtype=np.uint8)
+        self.colors[1:-1] = np.rint(self.band_colors * 255)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = None
+        self.future = None
+        self.generation = 0
+
+    def mappable(self):
+        # for a colorbar matching the overlay bands
+        cmap = ListedColormap(self.band_colors)
+        return ScalarMappable(norm=BoundaryNorm(self.levels, cmap.N), cmap=cmap)
+
+    def plane(self, axis, index):
+        key = [slice(None)] * 3
+        key[axis] = index
+        return self.dose_pct[tuple(key)]
+
+    @ct_profile.timed('dose_overlay')
+    def render(self, axis, index):
+        band = np.searchsorted(self.levels, self.plane(axis, index), side='left')
+        return self.colors[band]
+
+    def get(self, axis, index):
+        key = (axis, index)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        rgba = self.render(axis, index)
+        with self.lock:
+            self.cache[key] = rgba
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return rgba
+
+    def prefetch(self, planes, radius=4):
+        # render the planes around the current position in the background;
+        # planes maps axis -> current index.  Only the latest request is rendered: a
+        # queued one is cancelled and a running one stops before its next plane.
+        self.generation += 1
+        if self.future is not None:
+            self.future.cancel()
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=1)
+        keys = []
+        for step in range(1, radius + 1):
+            for axis, index in planes.items():
+                for i in (index + step, index - step):
+                    if 0 <= i < self.dose_pct.shape[axis]:
+                        keys.append((axis, i))
+        self.future = self.pool.submit(self._prefetch, keys[:self.maxsize // 2], self.generation)
+
+    def _prefetch(self, keys, generation):
+        for axis, index in keys:
+            if generation != self.generation:
+                return
+            with self.lock:
+                cached = (axis, index) in self.cache
+            if not cached:
+                self.get(axis, index)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+
+class growable_volume:
+    # Slices kept sorted by location in a buffer with spare capacity at both ends, so
+    # slices arriving in ascending or descending order are added without moving the others
+    # and one arriving out of order moves only the shorter side.  The buffer doubles when
+    # full, an amortized constant number of slice copies per slice.  voxel is a view.
+    def __init__(self, ny, nx, capacity=16, dtype=np.int16):
+        self.buffer = np.zeros((capacity, ny, nx), dtype=dtype)
+        self.start = capacity // 2
+        self.z = []
+
+    def __len__(self):
+        return len(self.z)
+
+    @property
+    def voxel(self):
+        return self.buffer[self.start:self.start+len(self.z)]
+
+    def grow(self):
+        n = len(self.z)
+        capacity = max(2 * len(self.buffer), 16)
+        buffer = np.zeros((capacity,) + self.buffer.shape[1:], dtype=self.buffer.dtype)
+        start = (capacity - n) // 2
+        buffer[start:start+n] = self.voxel
+        self.buffer, self.start = buffer, start
+
+    def insert(self, z, plane):
+        # store plane at location z and return its index
+        i = bisect.bisect(self.z, z)
+        n = len(self.z)
+        front, back = self.start > 0, self.start + n < len(self.buffer)
+        if not front and not back:
+            self.grow()
+            front = back = True
+        s = self.start
+        if front and (i < n - i or not back):
+            self.buffer[s-1:s-1+i] = self.buffer[s:s+i]
+            self.start -= 1
+        else:
+            self.buffer[s+i+1:s+n+1] = self.buffer[s+i:s+n]
+        self.buffer[self.start+i] = plane
+        self.z.insert(i, z)
+        return i
+
+
+class dicom_watcher:
+    # Finds and decodes the .dcm files of a folder that is still being written.  Each
+    # poll() returns the slices of files not seen before; a file that cannot be read yet
+    # (still being copied) is retried once its size or modification time changes.
+    def __init__(self, ct_dir):
+        self.dir = ct_dir
+        self.done = set()
+        self.pending = {}    # file -> [size, mtime_ns] when it last failed
+        self.failed = {}     # file -> reason, for slices that do not fit the series
+        self.geometry = None
+
+    def poll(self):
+        slices = []
+        for f, stat in sorted(dicom_file_stats(self.dir).items()):
+            if f in self.done or f in self.failed or self.pending.get(f) == stat:
+                continue
+            path = os.path.join(self.dir, f)
+            try:
+                info, ds = _dicom_slice_info(path)
+                geometry = _dicom_geometry(ds)
+                raw = None if info['offset'] is None else \
+                    (info['offset'], info['dtype'], geometry['ny'], geometry['nx'], info['slope'], info['intercept'])
+                pixels = _decode_dicom_slice(path, raw)
+            except Exception:
+                self.pending[f] = stat
+                continue
+            self.pending.pop(f, None)
+            if self.geometry is None:
+                self.geometry = geometry
+            elif (geometry['nx'], geometry['ny']) != (self.geometry['nx'], self.geometry['ny']):
+                self.failed[f] = '{:d} x {:d} pixels do not match the series'.format(geometry['nx'], geometry['ny'])
+                continue
+            self.done.add(f)
+            slices.append({'file': path, 'z': info['z'], 'pixels': pixels, 'geometry': geometry})
+        return slices
+
+
+# projection modes and the ufunc that combines planes for each; Average divides the sum
+PROJECTIONS = {'MIP': np.maximum, 'MinIP': np.minimum, 'Average': np.add}
+SLAB_CACHE_SIZE = 6   # thick-slab windows kept per ct_img, one per view, mode and thickness
+
+
+def _plane_key(axis, start, stop):
+    key = [slice(None)] * 3
+    key[axis] = slice(start, stop)
+    return tuple(key)
+
+
+class slab_window:
+    # Projection of a slab of `thickness` planes along axis, following a moving center
+    # plane.  Average keeps a running sum that adds the planes entering the slab and
+    # subtracts those leaving it.  MIP and MinIP split the axis into blocks of about
+    # sqrt(thickness) planes (van Herk / Gil-Werman): whole blocks inside the slab are
+    # combined from cached aggregates, and the two partial blocks at its ends from cached
+    # running maxima (or minima) within each block, so each plane is read about once as
+    # the slab moves.
+    def __init__(self, voxel, axis, mode, thickness):
+        self.voxel = voxel
+        self.axis = axis
+        self.mode = mode
+        self.ufunc = PROJECTIONS[mode]
+        self.thickness = min(thickness, voxel.shape[axis])
+        self.block = max(1, int(np.sqrt(self.thickness)))
+        self.blocks = {}     # block aggregates
+        self.prefixes = {}   # running aggregates from the start of a block, plane index first
+        self.suffixes = {}   # running aggregates to the end of a block
+        self.lo = self.hi = 0   # current slab, planes lo..hi-1
+        self.sum = None
+
+    def planes(self, start, stop):
+        return np.asarray(self.voxel[_plane_key(self.axis, start, stop)])
+
+    def scan_block(self, k):
+        # prefix and suffix aggregates of block k, read once for both
+        n = self.voxel.shape[self.axis]
+        planes = np.moveaxis(self.planes(k * self.block, min((k + 1) * self.block, n)), self.axis, 0)
+        self.prefixes[k] = self.ufunc.accumulate(planes, axis=0)
+        self.suffixes[k] = self.ufunc.accumulate(planes[::-1], axis=0)[::-1]
+        self.blocks[k] = self.prefixes[k][-1]
+
+    def get(self, center):
+        n = self.voxel.shape[self.axis]
+        lo = min(max(center - self.thickness // 2, 0), n - self.thickness)
+        hi = lo + self.thickness
+        if self.mode == 'Average':
+            if self.sum is None or lo >= self.hi or hi <= self.lo:
+                self.sum = self.planes(lo, hi).sum(axis=self.axis, dtype=np.int64)
+            else:
+                for start, stop, sign in ((lo, self.lo, 1), (self.lo, lo, -1), (self.hi, hi, 1), (hi, self.hi, -1)):
+                    if start < stop:
+                        self.sum += sign * self.planes(start, stop).sum(axis=self.axis, dtype=np.int64)
+            self.lo, self.hi = lo, hi
+            return np.rint(self.sum / self.thickness).astype(np.int16)
+
+        b = self.block
+        first, last = -(-lo // b), hi // b   # blocks first..last-1 lie inside the slab
+        self.blocks = {k: v for k, v in self.blocks.items() if first - 1 <= k <= last}
+        self.prefixes = {k: v for k, v in self.prefixes.items() if last - 1 <= k <= last + 1}
+        self.suffixes = {k: v for k, v in self.suffixes.items() if first - 2 <= k <= first}
+        parts = []
+        for k in range(first, last):
+            if k not in self.blocks:
+                self.blocks[k] = self.ufunc.reduce(self.planes(k * b, (k + 1) * b), axis=self.axis)
+            parts.append(self.blocks[k])
+        if lo < first * b:
+            if first - 1 not in self.suffixes:
+                self.scan_block(first - 1)
+            parts.append(self.suffixes[first - 1][lo - (first - 1) * b])
+        if last * b < hi:
+            if last not in self.prefixes:
+                self.scan_block(last)
+            parts.append(self.prefixes[last][hi - last * b - 1])
+        self.lo, self.hi = lo, hi
+        out = parts[0].copy()
+        for part in parts[1:]:
+            self.ufunc(out, part, out=out)
+        return out
+
+
+DVH_CACHE_SIZE = 64    # dose-volume histograms kept per ct_img
+MASK_CACHE_SIZE = 4    # HU-thresholded masks kept per ct_img, reused across dose files
+
+
+class dose_histogram:
+    # Dose-volume histogram of a mask: counts[i] voxels with dose in [edges[i], edges[i+1]),
+    # the last bin closed.  Mean and max are exact, not binned.
+    def __init__(self, counts, edges, dose_sum, dose_max, voxel_volume):
+        self.counts = counts
+        self.edges = edges
+        self.voxels = int(counts.sum())
+        self.mean = dose_sum / self.voxels if self.voxels > 0 else 0.
+        self.max = dose_max
+        self.voxel_volume = voxel_volume   # cm3
+
+    @property
+    def volume(self):
+        return self.voxels * self.voxel_volume
+
+    def differential(self):
+        # fraction of the mask volume in each bin
+        return self.counts / max(self.voxels, 1)
+
+    def cumulative(self):
+        # fraction of the mask volume receiving at least edges[i]
+        above = np.append(np.cumsum(self.counts[::-1])[::-1], 0)
+        return above / max(self.voxels, 1)
+
+    def percentile(self, p):
+        # D_p, the dose received by at least p percent of the mask volume, interpolated
+        # within its bin
+        return float(np.interp(p / 100., self.cumulative()[::-1], self.edges[::-1]))
+
+    def volume_at(self, dose):
+        # V_dose, the fraction of the mask volume receiving at least dose
+        return float(np.interp(dose, self.edges, self.cumulative()))
+
+    def stats(self, percentiles=(2, 50, 95, 98)):
+        stats = {'voxels': self.voxels, 'volume_cc': self.volume, 'mean': self.mean, 'max': self.max}
+        for p in percentiles:
+            stats['D{:g}'.format(p)] = self.percentile(p)
+        return stats
+
+
+class summed_volume:
+    # Summed-volume tables over block x block x block voxel blocks of a volume and of its
+    # squares, padded with a zero plane on each axis.  The sum over a box is eight lookups
+    # for the whole blocks inside it plus the voxels of the thin shell between those blocks
+    # and the box faces, so a query costs the box surface, not its volume.  Built slab by
+    # slab; takes 16 / block**3 bytes per voxel (1/4 byte at the default block of 4).
+    def __init__(self, voxel, slab=16, block=4, callback=None):
+        # callback(done, total) is called after each slab of z slices; returning False stops
+        # the build and leaves complete False
+        nz, ny, nx = voxel.shape
+        self.voxel = voxel
+        self.shape = (nz, ny, nx)
+        self.block = block
+        self.grid = grid = tuple(-(-n // block) for n in self.shape)
+        self.sum = np.zeros(tuple(g+1 for g in grid), dtype=np.int64)
+        self.sum2 = np.zeros(tuple(g+1 for g in grid), dtype=np.int64)
+        slab = max(slab // block, 1) * block
+        self.complete = False
+        for z in range(0, nz, slab):
+            values = np.zeros((slab, grid[1] * block, grid[2] * block), dtype=np.int64)
+            part = np.asarray(voxel[z:z+slab])
+            values[:len(part), :ny, :nx] = part
+            kz = -(-len(part) // block)
+            values = values[:kz * block].reshape(kz, block, grid[1], block, grid[2], block)
+            k = z // block
+            for table, v in ((self.sum, values), (self.sum2, values * values)):
+                table[k+1:k+1+kz, 1:, 1:] = v.sum(axis=(1, 3, 5)).cumsum(1).cumsum(2).cumsum(0) + table[k, 1:, 1:]
+            if callback is not None and callback(min(z + slab, nz), nz) is False:
+                return
+        self.complete = True
+
+
+    def box_sum(self, table, box):
+        # sum over whole blocks k1 <= k < k2 on each axis, box = (kx1, kx2, ky1, ky2, kz1, kz2)
+        x1, x2, y1, y2, z1, z2 = box
+        return int(table[z2, y2, x2] - table[z1, y2, x2] - table[z2, y1, x2] - table[z2, y2, x1]
+                   + table[z1, y1, x2] + table[z1, y2, x1] + table[z2, y1, x1] - table[z1, y1, x1])
+
+
+    def voxel_sums(self, lo, hi):
+        # sum and sum of squares of the voxels lo[a] <= i < hi[a], (z, y, x)
+        if any(l >= h for l, h in zip(lo, hi)):
+            return 0, 0
+        values = np.asarray(self.voxel[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]], dtype=np.int64)
+        return int(values.sum()), int((values * values).sum())
+
+
+    def stats(self, box):
+        # count, mean and standard deviation over the inclusive box (x1, x2, y1, y2, z1, z2)
+        x1, x2, y1, y2, z1, z2 = box
+        n = (x2-x1+1) * (y2-y1+1) * (z2-z1+1)
+        lo, hi = [z1, y1, x1], [z2+1, y2+1, x2+1]
+        # whole blocks inside the box; the last, partial block of an axis counts if the box reaches the end
+        kl = [-(-l // self.block) for l in lo]
+        kh = [g if h == size else h // self.block for h, size, g in zip(hi, self.shape, self.grid)]
+        if any(a >= b for a, b in zip(kl, kh)):
+            s, s2 = self.voxel_sums(lo, hi)
+        else:
+            core = (kl[2], kh[2], kl[1], kh[1], kl[0], kh[0])
+            s, s2 = self.box_sum(self.sum, core), self.box_sum(self.sum2, core)
+            cl = [k * self.block for k in kl]
+            ch = [min(k * self.block, size) for k, size in zip(kh, self.shape)]
+            # the shell: slabs below and above the core on z, then on y within it, then on x
+            for axis in range(3):
+                for a, b in ((lo[axis], cl[axis]), (ch[axis], hi[axis])):
+                    l = cl[:axis] + [a] + lo[axis+1:]
+                    h = ch[:axis] + [b] + hi[axis+1:]
+                    ps, ps2 = self.voxel_sums(l, h)
+                    s, s2 = s + ps, s2 + ps2
+        return n, s / n, np.sqrt((n * s2 - s * s) / n**2)   # python ints, so the variance is exact
+
+
+def box_histogram(voxel, box, step=1, slab=16):
+    # Counts of every int16 value in the inclusive box, index 0 being -32768, read a slab
+    # at a time.  step > 1 samples every step-th voxel along each axis.
+    x1, x2, y1, y2, z1, z2 = box
+    counts = np.zeros(65536, dtype=np.int64)
+    for z in range(z1, z2+1, slab * step):
+        block = np.asarray(voxel[z:min(z+slab*step, z2+1):step, y1:y2+1:step, x1:x2+1:step], dtype=np.int16)
+        counts += np.bincount(block.view(np.uint16).ravel(), minlength=65536)
+    return np.roll(counts, 32768)
+
+
+def histogram_stats(counts):
+    # count, mean, standard deviation, min and max of the values counted by box_histogram
+    values = np.nonzero(counts)[0]
+    if len(values) == 0:
+        return 0, np.nan, np.nan, None, None
+    hu = values - 32768
+    n = int(counts[values].sum())
+    mean = np.dot(counts[values], hu) / n
+    std = np.sqrt(np.dot(counts[values], (hu - mean)**2) / n)
+    return n, mean, std, int(hu[0]), int(hu[-1])
+
 
 class ct_img:
-    def __init__(self, ct_input=None, prefix='ct'):
+    def __init__(self, ct_input=None, prefix='ct', workers=None, mmap=False):
         self.prefix = prefix
         self.havedose = False
+        self.pyramid = []
+        self.summed = None
+        self.dvh_cache = OrderedDict()
+        self.projections = {}
+        self.slab_windows = OrderedDict()
+        self.dose_err = None
+        self.mask_cache = OrderedDict()
         if ct_input is None:
             self.nx = self.ny = self.nz = 0
             self.dx = self.dy = self.dz = np.float32(0.0)
         else:
             if os.path.isdir(ct_input):     # combine dicom files into a single img file
                 self.dir = ct_input
-                self.dicom2img(ct_input)
+                self.dicom2img(ct_input, workers=workers)
             elif os.path.isfile(ct_input):  # read processed img file
                 self.dir = os.path.dirname(ct_input)
-                self.read_img(ct_input)
+                self.read_img(ct_input, mmap=mmap)
             else:
                 raise Exception('Cannot find {:}'.format(ct_input))
 
 
-    def dicom2img(self, ct_dir):
-        os.chdir(ct_dir)
-        files = [f for f in os.listdir('.') if f.endswith('.dcm')]
+    def dicom2img(self, ct_dir, workers=None, use_processes=False):
+        self.read_dicom_headers(ct_dir)
+        self.decode_dicom(workers=workers, use_processes=use_processes)
+
+
+    def read_dicom_headers(self, ct_dir, use_index=True):
+        # first pass: read headers only (no pixel data) to sort files by slice location.
+        # A per-folder index keyed on file names, sizes and mtimes skips this pass
+        # entirely when the series has been opened before.
+        stats = dicom_file_stats(ct_dir)
+        if len(stats) == 0:
+            raise Exception('No DICOM files (.dcm) are found in {:}'.format(ct_dir))
+
+        index = load_dicom_index(ct_dir, stats) if use_index else None
+        if index is None:
+            index = self.index_dicom_headers(ct_dir, stats)
+            if use_index:
+                save_dicom_index(ct_dir, index)
+
+        slices = index['slices']
+        self.dicom_files = [os.path.join(ct_dir, s['file']) for s in slices]
+        self.dicom_raw = [None if s['offset'] is None else
+                          (s['offset'], s['dtype'], index['ny'], index['nx'], s['slope'], s['intercept']) for s in slices]
+        self.nx = index['nx']
+        self.ny = index['ny']
+        self.nz = len(slices)
+        self.dx, self.dy = np.array([index['dx'], index['dy']], dtype=np.float32)
+        self.dz = np.float32(index['dz'])
+        self.rescale_slope = index['rescale_slope']
+        self.rescale_intercept = index['rescale_intercept']
+        self.rescale_type = index['rescale_type']
+
+
+    @ct_profile.timed('header_parse')
+    def index_dicom_headers(self, ct_dir, stats):
+        slices = []
+        for f in stats:
+            info, ds = _dicom_slice_info(os.path.join(ct_dir, f))
+            slices.append(info)
+        slices.sort(key=lambda s: s['z'])
+        index = {'version': DICOM_INDEX_VERSION, 'files': stats, 'slices': slices}
+        index.update(_dicom_geometry(ds))
+        return index
 
-        # sort DICOM files accodring to slice locations
-        file_z = []
-        for f in files:
-            ds = pydicom.dcmread(f)
-            z = float(ds.SliceLocation)
-            file_z.append((f, z))
-        files = [f[0] for f in sorted(file_z, key=lambda tuple: tuple[1])]
-        self.nx = ds.Columns
-        self.ny = ds.Rows
-        self.nz = len(files)
-        self.dx, self.dy = np.array(ds.PixelSpacing, dtype=np.float32)
-        self.dz = np.float32(ds.SliceThickness)
 
-        # read files as order to combine them into one 3D array
-        self.voxel = np.zeros((self.nz, self.ny, self.nx), dtype=np.int16)
-        for i in range(self.nz):
-            ds = pydicom.dcmread(files[i])
-            self.voxel[i,:,:] = ds.pixel_array
+    def decode_dicom(self, workers=None, use_processes=False, order=None, callback=None):
+        # second pass: decode slices on a worker pool straight into the preallocated volume,
+        # applying rescale slope and intercept on the fly so water is HU=0.
+        # callback(i) is called after slice i is stored; returning False stops decoding
+        # and decode_dicom returns False with the remaining slices left at zero.
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if order is None:
+            order = range(self.nz)
+        voxel = getattr(self, 'voxel', None)
+        if not isinstance(voxel, np.ndarray) or voxel.shape != (self.nz, self.ny, self.nx) or not voxel.flags.writeable:
+            self.voxel = np.zeros((self.nz, self.ny, self.nx), dtype=np.int16)
+
+        if workers <= 1:
+            for i in order:
+                _decode_dicom_into(self.voxel, i, self.dicom_files[i], self.dicom_raw[i])
+                if callback is not None and callback(i) is False:
+                    return False
+            return True
+
+        # keep only a few slices in flight per worker so a cancel takes effect quickly and,
+        # for processes, pickled slices do not pile up
+        pool_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        order = list(order)
+        with pool_type(max_workers=workers) as pool:
+            pending = {}
+            next_i = 0
+            while pending or next_i < len(order):
+                while next_i < len(order) and len(pending) < workers * 2:
+                    i = order[next_i]
+                    if use_processes:
+                        future = pool.submit(_decode_dicom_slice, self.dicom_files[i], self.dicom_raw[i])
+                    else:
+                        future = pool.submit(_decode_dicom_into, self.voxel, i, self.dicom_files[i], self.dicom_raw[i])
+                    pending[future] = i
+                    next_i += 1
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    i = pending.pop(future)
+                    result = future.result()
+                    if use_processes:
+                        self.voxel[i] = result
+                    if callback is not None and callback(i) is False:
+                        for future in pending:
+                            future.cancel()
+                        return False
+        return True
+
+
+    def insert_slices(self, slices):
+        # Add slices from dicom_watcher.poll() to the volume in SliceLocation order and
+        # return the index each one was inserted at, in the order given.  The volume grows
+        # in place; caches built from the previous voxels are dropped.
+        if len(slices) == 0:
+            return []
+        if getattr(self, 'stream', None) is None:
+            geometry = slices[0]['geometry']
+            self.stream = growable_volume(geometry['ny'], geometry['nx'])
+            self.dicom_files = []
+            self.nx, self.ny = geometry['nx'], geometry['ny']
+            self.dx, self.dy = np.array([geometry['dx'], geometry['dy']], dtype=np.float32)
+            self.dz = np.float32(geometry['dz'])
+            self.rescale_slope = geometry['rescale_slope']
+            self.rescale_intercept = geometry['rescale_intercept']
+            self.rescale_type = geometry['rescale_type']
+        positions = []
+        for s in slices:
+            i = self.stream.insert(s['z'], s['pixels'])
+            self.dicom_files.insert(i, s['file'])
+            positions.append(i)
+        self.voxel = self.stream.voxel
+        self.nz = len(self.stream)
+        self.pyramid = []
+        self.summed = None
+        self.mask_cache.clear()
+        self.dvh_cache.clear()
+        self.clear_projections()
+        return positions
+
+
+    @ct_profile.timed('dicom_update')
+    def update_dicom(self, ct_dir):
+        # Watch mode: read the .dcm files added to ct_dir since the last call, decoding
+        # only those, and return their indices as insert_slices() does
+        if getattr(self, 'watcher', None) is None or self.watcher.dir != ct_dir:
+            self.dir = ct_dir
+            self.watcher = dicom_watcher(ct_dir)
+        return self.insert_slices(self.watcher.poll())
 
 
     def voxel_info(self):
@@ -53,22 +963,308 @@ class ct_img:
         return info
 
 
-    def read_img(self, img_file):
+    @ct_profile.timed('read_img')
+    def read_img(self, img_file, mmap=False):
         with open(img_file, 'rb') as f:
+            if f.read(len(IMG_V2_MAGIC)) == IMG_V2_MAGIC:
+                f.close()
+                self.read_img_v2(img_file, lazy=mmap)
+                return
+            f.seek(0)
             self.nx, self.ny, self.nz = struct.unpack('iii', f.read(12))
             self.dx, self.dy, self.dz = struct.unpack('fff', f.read(12))
-            self.voxel = np.fromfile(f, dtype=np.int16, count=self.nx*self.ny*self.nz).reshape(self.nz, self.ny, self.nx)
+            if not mmap:
+                self.voxel = np.fromfile(f, dtype=np.int16, count=self.nx*self.ny*self.nz).reshape(self.nz, self.ny, self.nx)
+        if mmap:  # read-only map over the voxels after the 24-byte header
+            self.voxel = np.memmap(img_file, dtype=np.int16, mode='r', offset=24, shape=(self.nz, self.ny, self.nx))
+
+
+    def read_img_v2(self, img_file, lazy=False):
+        # chunked v2 file: with lazy, chunks are only decompressed when a view or crop needs them
+        volume = chunked_volume(img_file)
+        self.nz, self.ny, self.nx = volume.shape
+        self.dx, self.dy, self.dz = volume.voxel_size
+        self.voxel = volume if lazy else volume[:, :, :]
+
+
+    @ct_profile.timed('write_img')
+    def write_img(self, img_file, box=None, version=1, chunks=IMG_V2_CHUNKS, level=6, slab=16, hu_luts=None):
+        # Stream the volume, or the inclusive box (x1, x2, y1, y2, z1, z2), to disk a few
+        # slices at a time so a crop is never copied whole.  version=2 writes the chunked,
+        # compressed format; the default legacy format is what the dose engine reads.
+        # With hu_luts from hu_conversion_luts(), density and material volumes are
+        # converted from the same slabs and written next to the .img.
+        if box is None:
+            box = (0, self.nx-1, 0, self.ny-1, 0, self.nz-1)
+        # write next to the targets and rename, so a memory-mapped source can be overwritten safely
+        outputs = []
+        if version == 2:
+            self.write_img_v2(img_file + '.tmp', box, chunks, level)
+        else:
+            outputs.append((img_file, None))
+        if hu_luts is not None:
+            outputs.extend(zip(hu_conversion_files(img_file), hu_luts))
+        self.write_slabs([(name + '.tmp', lut) for name, lut in outputs], box, slab)
+        if version == 2:
+            os.replace(img_file + '.tmp', img_file)
+        for name, lut in outputs:
+            os.replace(name + '.tmp', name)
+
+
+    def write_slabs(self, outputs, box, slab=16):
+        # write the box to each (file name, lut) in the legacy layout, the int16 HU passed
+        # through a lookup table unless lut is None, reading each slab of the source once
+        if len(outputs) == 0:
+            return
+        x1, x2, y1, y2, z1, z2 = box
+        header = struct.pack('iii', x2-x1+1, y2-y1+1, z2-z1+1) + struct.pack('fff', self.dx, self.dy, self.dz)
+        files = [open(name, 'wb') for name, lut in outputs]
+        try:
+            for f in files:
+                f.write(header)
+            for z in range(z1, z2+1, slab):
+                block = np.ascontiguousarray(self.voxel[z:min(z+slab, z2+1), y1:y2+1, x1:x2+1], dtype=np.int16)
+                for f, (name, lut) in zip(files, outputs):
+                    (block if lut is None else apply_lut(lut, block)).tofile(f)
+        finally:
+            for f in files:
+                f.close()
 
 
-    def write_img(self, img_file):
+    def write_img_v2(self, img_file, box, chunks=IMG_V2_CHUNKS, level=6):
+        x1, x2, y1, y2, z1, z2 = box
+        nx, ny, nz = x2-x1+1, y2-y1+1, z2-z1+1
+        cz, cy, cx = chunks
+        grid = (-(-nz // cz), -(-ny // cy), -(-nx // cx))
+        offsets = np.zeros(grid, dtype=np.uint64)
+        lengths = np.zeros(grid, dtype=np.uint64)
         with open(img_file, 'wb') as f:
-            f.write(struct.pack('iii', self.nx, self.ny, self.nz))
-            f.write(struct.pack('fff', self.dx, self.dy, self.dz))
-            f.write(self.voxel.tobytes())
-            f.close()
- 
+            f.write(struct.pack(IMG_V2_HEADER, IMG_V2_MAGIC, nx, ny, nz, self.dx, self.dy, self.dz, cz, cy, cx, IMG_V2_CODEC_ZLIB))
+            f.write(b'\0' * (offsets.size * 16))   # chunk index, filled in at the end
+            with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+                for iz in range(grid[0]):
+                    z = z1 + iz * cz
+                    slab = np.asarray(self.voxel[z:min(z+cz, z2+1), y1:y2+1, x1:x2+1], dtype=np.int16)
+                    keys = [(iy, ix) for iy in range(grid[1]) for ix in range(grid[2])]
+                    blocks = pool.map(lambda k: _compress_chunk(slab[:, k[0]*cy:(k[0]+1)*cy, k[1]*cx:(k[1]+1)*cx], level), keys)
+                    for (iy, ix), block in zip(keys, blocks):
+                        offsets[iz, iy, ix] = f.tell()
+                        lengths[iz, iy, ix] = len(block)
+                        f.write(block)
+            f.seek(struct.calcsize(IMG_V2_HEADER))
+            f.write(np.stack([offsets.ravel(), lengths.ravel()], axis=1).astype('<u8').tobytes())
+
+
+    def crop(self, x1, x2, y1, y2, z1, z2):
+        # sub-volume with inclusive bounds as the cut box of the GUI; voxels are a view, not a copy
+        for axis, lo, hi, n in (('x', x1, x2, self.nx), ('y', y1, y2, self.ny), ('z', z1, z2, self.nz)):
+            if not 0 <= lo <= hi < n:
+                raise Exception('Crop bounds {:} {:}..{:} are outside 0..{:}'.format(axis, lo, hi, n-1))
+        new = ct_img(prefix=self.prefix)
+        new.dir = getattr(self, 'dir', '.')
+        new.nx, new.ny, new.nz = x2-x1+1, y2-y1+1, z2-z1+1
+        new.dx, new.dy, new.dz = self.dx, self.dy, self.dz
+        new.voxel = self.voxel[z1:z2+1, y1:y2+1, x1:x2+1]
+        return new
+
+
+    @ct_profile.timed('resample')
+    def resample(self, new_dx, new_dy, new_dz, chunk=16, workers=1, callback=None):
+        # Volume-average resampling as img_resize.c, applied as separable per-axis
+        # weighting matrices over slabs of `chunk` new z slices.  Returns a new ct_img.
+        # callback(done, total) is called as new slices are stored; returning False stops
+        # the remaining slabs and resample returns None.
+        new_dx, new_dy, new_dz = np.float32(new_dx), np.float32(new_dy), np.float32(new_dz)
+        nnx = int(self.nx // 2 * np.float32(self.dx) / new_dx) * 2
+        nny = int(self.ny // 2 * np.float32(self.dy) / new_dy) * 2
+        nnz = int(self.nz // 2 * np.float32(self.dz) / new_dz) * 2
+        wx = bin_weights(nnx, new_dx, self.nx, self.dx)
+        wy = bin_weights(nny, new_dy, self.ny, self.dy)
+        wz = bin_weights(nnz, new_dz, self.nz, self.dz)
+        voxel_ratio = np.float32(self.dx) * np.float32(self.dy) * np.float32(self.dz) / (new_dx * new_dy * new_dz)
+
+        new = ct_img(prefix=self.prefix)
+        new.dir = getattr(self, 'dir', '.')
+        new.nx, new.ny, new.nz = nnx, nny, nnz
+        new.dx, new.dy, new.dz = new_dx, new_dy, new_dz
+        new.voxel = np.empty((nnz, nny, nnx), dtype=np.int16)
+
+        stopped = []
+        def resample_slab(k0):
+            if stopped:
+                return
+            k1 = min(k0 + chunk, nnz)
+            used = np.nonzero(wz[k0:k1].any(axis=0))[0]
+            z0, z1 = used[0], used[-1] + 1
+            slab = np.asarray(self.voxel[z0:z1], dtype=np.float64) @ wx.T      # (z, ny, nnx)
+            slab = np.matmul(wy, slab)                                            # (z, nny, nnx)
+            slab = np.tensordot(wz[k0:k1, z0:z1], slab, axes=1)                   # (k, nny, nnx)
+            new.voxel[k0:k1] = np.trunc(slab * voxel_ratio).astype(np.int16)
+
+        def slab_done(k0):
+            if callback is not None and callback(min(k0 + chunk, nnz), nnz) is False:
+                stopped.append(k0)
+            return not stopped
+
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for k0, _ in zip(range(0, nnz, chunk), pool.map(resample_slab, range(0, nnz, chunk))):
+                    if not slab_done(k0):
+                        break   # queued slabs return at once
+        else:
+            for k0 in range(0, nnz, chunk):
+                resample_slab(k0)
+                if not slab_done(k0):
+                    break
+        return None if stopped else new
+
+
+    @ct_profile.timed('summed_volume')
+    def build_summed_volume(self, slab=16, block=4, callback=None):
+        # callback as in summed_volume; a stopped build leaves self.summed unchanged and returns None
+        summed = summed_volume(self.voxel, slab, block, callback)
+        if not summed.complete:
+            return None
+        self.summed = summed
+        return self.summed
+
 
-    def read_dose(self, dose_file, verbose=False):
+    def box_stats(self, box):
+        # count, mean and std of HU over the inclusive box (x1, x2, y1, y2, z1, z2): from the
+        # summed-volume tables once build_summed_volume() has run, at the cost of the box
+        # surface; otherwise from a histogram of the whole box.  Min, max and the histogram
+        # itself come from box_histogram().
+        if self.summed is not None:
+            return self.summed.stats(box)
+        return histogram_stats(box_histogram(self.voxel, box))[:3]
+
+
+    @ct_profile.timed('projection')
+    def projection(self, axis, mode, chunk=16, workers=None):
+        # Whole-volume MIP, MinIP or Average along axis (0: z, 1: y, 2: x), as an int16
+        # plane like voxel[z], voxel[:, y] or voxel[:, :, x].  Slabs of z are reduced across
+        # a thread pool; the result is cached until clear_projections().
+        key = (axis, mode)
+        if key in self.projections:
+            return self.projections[key]
+        ufunc = PROJECTIONS[mode]
+        def project_slab(z):
+            block = np.asarray(self.voxel[z:z+chunk])
+            if mode == 'Average':
+                return block.sum(axis=axis, dtype=np.int64)
+            return ufunc.reduce(block, axis=axis)
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(project_slab, range(0, self.nz, chunk)))
+        plane = ufunc.reduce(parts) if axis == 0 else np.concatenate(parts, axis=0)
+        if mode == 'Average':
+            plane = np.rint(plane / self.voxel.shape[axis]).astype(np.int16)
+        self.projections[key] = plane
+        return plane
+
+
+    def slab_projection(self, axis, mode, center, thickness):
+        # projection of the `thickness` planes around plane center along axis
+        key = (axis, mode, thickness)
+        if key not in self.slab_windows:
+            self.slab_windows[key] = slab_window(self.voxel, axis, mode, thickness)
+            if len(self.slab_windows) > SLAB_CACHE_SIZE:
+                self.slab_windows.popitem(last=False)
+        self.slab_windows.move_to_end(key)
+        return self.slab_windows[key].get(center)
+
+
+    def clear_projections(self):
+        # drop cached projections after the voxels change
+        self.projections = {}
+        self.slab_windows = OrderedDict()
+
+
+    def view_plane(self, axis, index, mode=None, thickness=0):
+        # the plane at index along axis, or with a projection mode the whole-volume
+        # projection (thickness 0) or the thick slab around index
+        if mode is None or mode == 'Plane':
+            return self.voxel[_plane_key(axis, index, index+1)].squeeze(axis)
+        if thickness <= 0:
+            return self.projection(axis, mode)
+        return self.slab_projection(axis, mode, index, thickness)
+
+
+    def build_pyramid(self, min_size=256, workers=None, callback=None):
+        # Downsampled copies for interactive browsing, each level halving every axis
+        # still longer than min_size with the same volume average as resample().
+        # callback is passed to resample() for each level; if it stops one, the pyramid is
+        # left unchanged and build_pyramid returns None.
+        if workers is None:
+            workers = os.cpu_count() or 1
+        pyramid = []
+        level = self
+        while max(level.nx, level.ny, level.nz) > min_size:
+            fx, fy, fz = [2 if n > min_size else 1 for n in (level.nx, level.ny, level.nz)]
+            level = level.resample(level.dx * fx, level.dy * fy, level.dz * fz, workers=workers, callback=callback)
+            if level is None:
+                return None
+            pyramid.append(level)
+        self.set_pyramid_geometry(pyramid)
+        self.pyramid = pyramid   # assigned complete, as the GUI may be reading it from another thread
+        return self.pyramid
+
+
+    def set_pyramid_geometry(self, pyramid):
+        # origin and ratio of each level in voxel units of this volume, (x, y, z) order:
+        # level voxel i covers [origin + i * ratio, origin + (i + 1) * ratio)
+        origin = np.zeros(3)
+        ratio = np.ones(3)
+        parent = self
+        for level in pyramid:
+            r = np.array([level.dx / parent.dx, level.dy / parent.dy, level.dz / parent.dz], dtype=np.float64)
+            o = np.array([parent.nx // 2, parent.ny // 2, parent.nz // 2]) - np.array([level.nx // 2, level.ny // 2, level.nz // 2]) * r
+            origin = origin + ratio * o
+            ratio = ratio * r
+            level.origin = origin
+            level.ratio = ratio
+            parent = level
+
+
+    def write_pyramid(self, img_file):
+        for i, level in enumerate(self.pyramid):
+            level.write_img('{:}.pyr{:d}'.format(img_file, i + 1))
+
+
+    def read_pyramid(self, img_file, mmap=True):
+        # levels stored next to img_file as <img_file>.pyr1, .pyr2, ...; stale levels
+        # (older than the .img) are ignored
+        pyramid = []
+        mtime = os.path.getmtime(img_file)
+        while True:
+            level_file = '{:}.pyr{:d}'.format(img_file, len(pyramid) + 1)
+            if not os.path.isfile(level_file) or os.path.getmtime(level_file) < mtime:
+                break
+            pyramid.append(ct_img(level_file, mmap=mmap))
+        self.set_pyramid_geometry(pyramid)
+        self.pyramid = pyramid
+        return len(self.pyramid) > 0
+
+
+    def load_pyramid(self, img_file, min_size=256, workers=None, callback=None):
+        # read the stored pyramid of img_file, or build it and store it when possible;
+        # None if callback stopped the build, as in build_pyramid
+        if max(self.nx, self.ny, self.nz) <= min_size:
+            self.pyramid = []
+        elif not self.read_pyramid(img_file) or max(self.pyramid[-1].nx, self.pyramid[-1].ny, self.pyramid[-1].nz) > min_size:
+            if self.build_pyramid(min_size=min_size, workers=workers, callback=callback) is None:
+                return None
+            try:
+                self.write_pyramid(img_file)
+            except OSError:
+                pass
+        return self.pyramid
+
+
+    def read_dose_header(self, dose_file, verbose=False):
+        # (dose_x, dose_z, dose_e, x0, x1, z0, z1) of a .dose or .err file matching this image
         with open(dose_file, 'rb') as f:
             nx, ny, nz = struct.unpack('iii', f.read(12))
             dx, dy, dz = struct.unpack('fff', f.read(12))
@@ -77,21 +1273,233 @@ class ct_img:
                     print('Image: ({:d}, {:d}, {:d}) at ({:.3f}, {:.3f}, {:.3f}) mm'.format(self.nx, self.ny, self.nz, self.dx, self.dy, self.dz))
                     print('Dose:  ({:d}, {:d}, {:d}) at ({:.3f}, {:.3f}, {:.3f}) mm'.format(nx, ny, nz, dx, dy, dz))
                 raise Exception('Error: the image and dose voxels do not match.')
-            self.dose_x, self.dose_z, self.dose_e = struct.unpack('iif', f.read(12))
-            self.dose_x0, self.dose_x1 = struct.unpack('ii', f.read(8))
-            self.dose_z0, self.dose_z1 = struct.unpack('ii', f.read(8))
-            dose_nx = self.dose_x1 - self.dose_x0 + 1
-            dose_nz = self.dose_z1 - self.dose_z0 + 1
-            if verbose:
-                print('Dose at X = {:d}, Z = {:d}, Energy = {:.2f}'.format(self.dose_x, self.dose_z, self.dose_e))
-                print('Dose range is X({:d}, {:d}), Z({:d}, {:d})'.format(self.dose_x0, self.dose_x1, self.dose_z0, self.dose_z1))
-            self.dose = np.zeros_like(self.voxel, dtype=np.float32)
-            self.dose[self.dose_z0:self.dose_z1+1,:,self.dose_x0:self.dose_x1+1] = np.fromfile(f, dtype=np.float32, count=dose_nx*self.ny*dose_nz).reshape(dose_nz, self.ny, dose_nx)
-            self.dose_pct = self.dose / (self.dose.max() * 0.01)
-            self.havedose = True
-
-
-    def polt3views(self, ix=None, iy=None, iz=None, showdose=True, savefig=False):
+            dose_x, dose_z, dose_e = struct.unpack('iif', f.read(12))
+            x0, x1 = struct.unpack('ii', f.read(8))
+            z0, z1 = struct.unpack('ii', f.read(8))
+        if verbose:
+            print('Dose at X = {:d}, Z = {:d}, Energy = {:.2f}'.format(dose_x, dose_z, dose_e))
+            print('Dose range is X({:d}, {:d}), Z({:d}, {:d})'.format(x0, x1, z0, z1))
+        return dose_x, dose_z, dose_e, x0, x1, z0, z1
+
+
+    def map_dose_block(self, dose_file, header):
+        dose_x, dose_z, dose_e, x0, x1, z0, z1 = header
+        return np.memmap(dose_file, dtype=np.float32, mode='r', offset=DOSE_HEADER_SIZE, shape=(z1-z0+1, self.ny, x1-x0+1))
+
+
+    @ct_profile.timed('dose_read')
+    def read_dose(self, dose_file, verbose=False, mmap=False, callback=None):
+        # With mmap and a callback, the mapped block is scanned for its maximum before it
+        # replaces the current dose, calling callback(done, total) as in dose_volume.block_max;
+        # returning False stops and read_dose returns False with the current dose kept.
+        header = self.read_dose_header(dose_file, verbose)
+        block_max = None
+        if mmap and callback is not None:
+            block = self.map_dose_block(dose_file, header)
+            block_max = dose_volume(block, self.voxel.shape, header[3], header[5]).block_max(callback)
+            if block_max is None:
+                return False
+        self.dose_x, self.dose_z, self.dose_e, self.dose_x0, self.dose_x1, self.dose_z0, self.dose_z1 = header
+        if mmap:  # keep only the stored sub-block mapped; percent is computed per slice
+            self.set_dose_block(self.map_dose_block(dose_file, header), block_max)
+        else:
+            self.dose = np.zeros((self.nz, self.ny, self.nx), dtype=np.float32)   # a lazy voxel is not decompressed
+            self.dose[self.dose_z0:self.dose_z1+1,:,self.dose_x0:self.dose_x1+1] = self.map_dose_block(dose_file, header)
+            self.dose_block = self.dose[self.dose_z0:self.dose_z1+1,:,self.dose_x0:self.dose_x1+1]
+            with ct_profile.timer('dose_normalize'):
+                self.dose_pct = self.dose / (self.dose.max() * 0.01)
+            self.dose_max = None
+            self.dvh_cache.clear()   # masks stay valid for any dose with the same block
+        self.dose_err = None
+        self.havedose = True
+        return True
+
+
+    def set_dose_block(self, block, block_max=None):
+        # use block, stored for dose_z0..dose_z1 and dose_x0..dose_x1, as the current dose;
+        # block_max, if already known, saves scanning the block again
+        self.dose_block = block
+        self.dose = dose_volume(block, self.voxel.shape, self.dose_x0, self.dose_z0)
+        self.dose_pct = dose_volume(block, self.voxel.shape, self.dose_x0, self.dose_z0, percent=True)
+        self.dose._max = self.dose_pct._max = self.dose_max = block_max
+        self.dvh_cache.clear()   # masks stay valid for any dose with the same block
+        self.havedose = True
+
+
+    @ct_profile.timed('dose_sum')
+    def sum_doses(self, dose_files, weights=None, err_files=None, relative_err=False, slab=16, callback=None):
+        # Accumulate sum(weights[i] * dose_i) into one float32 block spanning the union of
+        # the stored blocks, which replaces the current dose.  Each file is memory-mapped and
+        # added a few slices at a time, so only the sum is held in memory.  With err_files
+        # (one per dose file, standard uncertainties in dose units, or fractions of the dose
+        # with relative_err), the weighted uncertainties are added in quadrature into
+        # self.dose_err.  callback(i) is called after file i; returning False stops the sum
+        # and returns False.
+        if weights is None:
+            weights = [1.] * len(dose_files)
+        if len(weights) != len(dose_files) or (err_files is not None and len(err_files) != len(dose_files)):
+            raise Exception('Each dose file needs one weight and one error file')
+        headers = [self.read_dose_header(f) for f in dose_files]
+        if err_files is not None:
+            for f, header in zip(err_files, headers):
+                if self.read_dose_header(f)[3:] != header[3:]:
+                    raise Exception('{:} does not cover the same block as its dose file'.format(f))
+        x0 = min(h[3] for h in headers)
+        x1 = max(h[4] for h in headers)
+        z0 = min(h[5] for h in headers)
+        z1 = max(h[6] for h in headers)
+        total = np.zeros((z1-z0+1, self.ny, x1-x0+1), dtype=np.float32)
+        variance = None if err_files is None else np.zeros_like(total)
+
+        for i, (dose_file, weight, header) in enumerate(zip(dose_files, weights, headers)):
+            dose = self.map_dose_block(dose_file, header)
+            err = None if err_files is None else self.map_dose_block(err_files[i], header)
+            zs, xs = header[5] - z0, header[3] - x0
+            weight = np.float32(weight)
+            for z in range(0, dose.shape[0], slab):
+                d = np.asarray(dose[z:z+slab])
+                dst = (slice(zs+z, zs+z+len(d)), slice(None), slice(xs, xs+d.shape[2]))
+                total[dst] += d if weight == 1 else weight * d
+                if err is not None:
+                    e = weight * np.asarray(err[z:z+slab])
+                    if relative_err:
+                        e *= d
+                    variance[dst] += e * e
+            if callback is not None and callback(i) is False:
+                return False
+
+        self.dose_x, self.dose_z, self.dose_e = headers[0][:3]
+        self.dose_x0, self.dose_x1, self.dose_z0, self.dose_z1 = x0, x1, z0, z1
+        self.set_dose_block(total)
+        if variance is not None:
+            self.dose_err = dose_volume(np.sqrt(variance, out=variance), self.voxel.shape, x0, z0)
+        else:
+            self.dose_err = None
+        return True
+
+
+    def write_dose(self, dose_file, err_file=None):
+        # write the current dose block, and its uncertainty if any, in the .dose format
+        header = struct.pack('iii', self.nx, self.ny, self.nz) + struct.pack('fff', self.dx, self.dy, self.dz)
+        header += struct.pack('iif', self.dose_x, self.dose_z, self.dose_e)
+        header += struct.pack('ii', self.dose_x0, self.dose_x1) + struct.pack('ii', self.dose_z0, self.dose_z1)
+        outputs = [(dose_file, self.dose_block)]
+        if err_file is not None:
+            outputs.append((err_file, self.dose_err.block))
+        for name, block in outputs:
+            with open(name + '.tmp', 'wb') as f:
+                f.write(header)
+                for z in range(0, block.shape[0], 16):
+                    np.ascontiguousarray(block[z:z+16], dtype=np.float32).tofile(f)
+            os.replace(name + '.tmp', name)
+
+
+    def dose_block_max(self):
+        if self.dose_max is None:
+            self.dose_max = dose_volume(self.dose_block, self.voxel.shape, self.dose_x0, self.dose_z0).block_max()
+        return self.dose_max
+
+
+    def dvh_mask(self, box, hu_range=None, slab=16):
+        # Mask of the voxels with hu_range[0] <= HU <= hu_range[1] over the box clipped to
+        # the dose block, and the number of such voxels in the whole box.  The mask is None
+        # without hu_range.  Cached per box, HU range and dose block extent.
+        x1, x2, y1, y2, z1, z2 = box
+        key = (box, hu_range, self.dose_x0, self.dose_x1, self.dose_z0, self.dose_z1)
+        if key in self.mask_cache:
+            self.mask_cache.move_to_end(key)
+            return self.mask_cache[key]
+        if hu_range is None:
+            return None, (x2-x1+1) * (y2-y1+1) * (z2-z1+1)
+
+        lo, hi = max(hu_range[0], -32768), min(hu_range[1], 32767)
+        def count_in_range(xa, xb, za, zb):
+            n = 0
+            for z in range(za, zb+1, slab):
+                block = np.asarray(self.voxel[z:min(z+slab, zb+1), y1:y2+1, xa:xb+1])
+                n += int(np.count_nonzero((block >= lo) & (block <= hi)))
+            return n
+
+        bx1, bx2 = max(x1, self.dose_x0), min(x2, self.dose_x1)
+        bz1, bz2 = max(z1, self.dose_z0), min(z2, self.dose_z1)
+        mask = np.zeros((max(bz2-bz1+1, 0), y2-y1+1, max(bx2-bx1+1, 0)), dtype=bool)
+        for z in range(bz1, bz2+1, slab):
+            block = np.asarray(self.voxel[z:min(z+slab, bz2+1), y1:y2+1, bx1:bx2+1])
+            np.logical_and(block >= lo, block <= hi, out=mask[z-bz1 : z-bz1+len(block)])
+        # only the part of the box outside the dose block is counted again
+        if mask.size == 0:
+            total = count_in_range(x1, x2, z1, z2)
+        else:
+            total = (int(np.count_nonzero(mask)) + count_in_range(x1, x2, z1, bz1-1) + count_in_range(x1, x2, bz2+1, z2)
+                     + count_in_range(x1, bx1-1, bz1, bz2) + count_in_range(bx2+1, x2, bz1, bz2))
+        self.mask_cache[key] = (mask, total)
+        if len(self.mask_cache) > MASK_CACHE_SIZE:
+            self.mask_cache.popitem(last=False)
+        return mask, total
+
+
+    @ct_profile.timed('dvh')
+    def dvh(self, box=None, hu_range=None, bins=1000, slab=16, workers=None):
+        # Dose-volume histogram over the inclusive box (x1, x2, y1, y2, z1, z2), default the
+        # whole volume, optionally of the voxels within hu_range only.  Only the stored dose
+        # block is histogrammed; the rest of the mask counts as zero dose.  Bins span zero to
+        # the dose maximum in the units of the dose file.  Cached until the next read_dose().
+        if box is None:
+            box = (0, self.nx-1, 0, self.ny-1, 0, self.nz-1)
+        box = tuple(int(v) for v in box)
+        hu_range = None if hu_range is None else tuple(hu_range)
+        key = (box, hu_range, bins)
+        if key in self.dvh_cache:
+            self.dvh_cache.move_to_end(key)
+            return self.dvh_cache[key]
+
+        x1, x2, y1, y2, z1, z2 = box
+        mask, total = self.dvh_mask(box, hu_range, slab)
+        top = self.dose_block_max()
+        scale = np.float32(bins / top if top > 0 else 0.)
+        bx1, bx2 = max(x1, self.dose_x0) - self.dose_x0, min(x2, self.dose_x1) - self.dose_x0
+        bz1, bz2 = max(z1, self.dose_z0) - self.dose_z0, min(z2, self.dose_z1) - self.dose_z0
+
+        buffers = threading.local()
+        def histogram_slab(z):
+            dose = np.asarray(self.dose_block[z:min(z+slab, bz2+1), y1:y2+1, bx1:bx2+1])
+            if mask is not None:
+                dose = dose[mask[z-bz1 : z-bz1+slab]]
+            if dose.size == 0:
+                return 0, 0., 0.
+            # bin index computed in place into a buffer reused by each thread across slabs
+            if getattr(buffers, 'index', None) is None or buffers.index.size < dose.size:
+                buffers.index = np.empty(dose.size, dtype=np.intp)
+            index = buffers.index[:dose.size].reshape(dose.shape)
+            np.multiply(dose, scale, out=index, casting='unsafe')
+            np.clip(index, 0, bins - 1, out=index)
+            return np.bincount(index.ravel(), minlength=bins), float(dose.sum()), float(dose.max())
+
+        slabs = range(bz1, bz2+1 if bx1 <= bx2 else bz1, slab)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(histogram_slab, slabs))
+        else:
+            results = [histogram_slab(z) for z in slabs]
+        counts = np.zeros(bins, dtype=np.int64)
+        dose_sum = dose_max = 0.
+        for slab_counts, slab_sum, slab_max in results:
+            counts += slab_counts
+            dose_sum += slab_sum
+            dose_max = max(dose_max, slab_max)
+        counts[0] += total - counts.sum()   # mask voxels outside the dose block
+
+        result = dose_histogram(counts, np.linspace(0., top, bins + 1), dose_sum, dose_max,
+                                float(self.dx * self.dy * self.dz) / 1000.)
+        self.dvh_cache[key] = result
+        if len(self.dvh_cache) > DVH_CACHE_SIZE:
+            self.dvh_cache.popitem(last=False)
+        return result
+
+
+    def polt3views(self, ix=None, iy=None, iz=None, showdose=True, savefig=False, window=None, projection=None, thickness=0):
         if ix == None:
             ix = self.nx // 2
         if iy == None:
@@ -116,9 +1524,20 @@ class ct_img:
         pxz = plt.axes(xz)
         pzy = plt.axes(zy)
         
-        pxy.imshow(self.voxel[iz,:,:], cmap='gray')
-        pxz.imshow(self.voxel[:,iy,:], cmap='gray', aspect=self.dz/self.dx)
-        pzy.imshow(self.voxel[:,:,ix].transpose(), cmap='gray', aspect=self.dy/self.dz)
+        # projection 'MIP', 'MinIP' or 'Average' shows whole-volume projections, or thick slabs
+        # of `thickness` planes around the given ones
+        img_xy = self.view_plane(0, iz, projection, thickness)
+        img_xz = self.view_plane(1, iy, projection, thickness)
+        img_zy = self.view_plane(2, ix, projection, thickness)
+        if window is None:
+            pxy.imshow(img_xy, cmap='gray')
+            pxz.imshow(img_xz, cmap='gray', aspect=self.dz/self.dx)
+            pzy.imshow(img_zy.transpose(), cmap='gray', aspect=self.dy/self.dz)
+        else:  # a preset name or (level, width) gives the same contrast in all views
+            lut = window_lut(*(WINDOW_PRESETS[window] if isinstance(window, str) else window))
+            pxy.imshow(apply_lut(lut, img_xy))
+            pxz.imshow(apply_lut(lut, img_xz), aspect=self.dz/self.dx)
+            pzy.imshow(apply_lut(lut, img_zy).transpose(1, 0, 2), aspect=self.dy/self.dz)
 
         if showdose and self.havedose:
             levels = [0.02, 0.1, 1, 10, 100]
@@ -0,0 +1,126 @@
+# Optional timing of the expensive stages in ct_image and the GUI
+#
+# Timing is off until enable() is called; while off, timer() costs one flag check.
+# stats() returns counters and histograms per stage, and export_trace() writes the
+# recorded spans as a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+import os
+import json
+import time
+import functools
+import threading
+from collections import deque
+
+# upper bounds in ms of the histogram buckets; the last bucket holds everything slower
+HISTOGRAM_BOUNDS = [0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000]
+
+_enabled = False
+_lock = threading.Lock()
+_stats = {}
+_events = deque(maxlen=100000)
+_t0 = time.perf_counter()
+
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+        _events.clear()
+
+
+def record(name, start, seconds):
+    ms = seconds * 1000.
+    bucket = 0
+    while bucket < len(HISTOGRAM_BOUNDS) and ms > HISTOGRAM_BOUNDS[bucket]:
+        bucket += 1
+    with _lock:
+        s = _stats.get(name)
+        if s is None:
+            s = _stats[name] = {'count': 0, 'total_ms': 0., 'min_ms': ms, 'max_ms': ms,
+                                'histogram': [0] * (len(HISTOGRAM_BOUNDS) + 1)}
+        s['count'] += 1
+        s['total_ms'] += ms
+        s['min_ms'] = min(s['min_ms'], ms)
+        s['max_ms'] = max(s['max_ms'], ms)
+        s['histogram'][bucket] += 1
+        _events.append((name, start, seconds, threading.get_ident()))
+
+
+class _timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class _no_timer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMER = _no_timer()
+
+
+def timer(name):
+    # with timer('stage'): ...
+    return _timer(name) if _enabled else _NO_TIMER
+
+
+def timed(name):
+    # decorator form of timer()
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def stats():
+    # {stage: count, total/mean/min/max in ms, histogram counts over HISTOGRAM_BOUNDS}
+    with _lock:
+        out = {}
+        for name, s in _stats.items():
+            out[name] = dict(s, histogram=list(s['histogram']), mean_ms=s['total_ms'] / s['count'])
+        return out
+
+
+def report():
+    lines = ['{:24s} {:>8s} {:>10s} {:>10s} {:>10s}'.format('stage', 'count', 'mean ms', 'max ms', 'total ms')]
+    for name, s in sorted(stats().items(), key=lambda item: -item[1]['total_ms']):
+        lines.append('{:24s} {:8d} {:10.3f} {:10.3f} {:10.1f}'.format(name, s['count'], s['mean_ms'], s['max_ms'], s['total_ms']))
+    return '\n'.join(lines)
+
+
+def export_trace(trace_file):
+    with _lock:
+        events = list(_events)
+    trace = [{'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+              'ts': (start - _t0) * 1e6, 'dur': seconds * 1e6} for name, start, seconds, tid in events]
+    with open(trace_file, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms', 'stats': stats()}, f)
+
+
+if os.environ.get('CT_PROFILE'):
+    enable()
@@ -0,0 +1,184 @@
+# Convert DICOM series folders into .img files without the GUI
+#
+# Usage: python dicom_batch.py [options] folder [folder ...]
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ct_image import ct_img, hu_conversion_luts, read_hu_conversion, hu_conversion_files
+
+
+def find_series(paths, scan=False):
+    # (series folder, root) of the folders holding .dcm files; with scan, every such folder below each path
+    series = []
+    for path in paths:
+        if scan:
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                if any(f.endswith('.dcm') for f in files):
+                    series.append((root, path))
+        elif any(f.endswith('.dcm') for f in os.listdir(path)):
+            series.append((path, path))
+    return series
+
+
+def output_file(series_dir, output_dir=None, root=None):
+    # named after the series folder; in a shared output folder, after its path below root
+    # joined by '_' so that p1/CT and p2/CT become p1_CT.img and p2_CT.img
+    series_dir = os.path.normpath(series_dir)
+    name = os.path.basename(series_dir)
+    if output_dir is not None and root is not None:
+        relative = os.path.relpath(series_dir, os.path.normpath(root))
+        if relative != os.curdir:
+            name = relative.replace(os.sep, '_')
+    return os.path.join(series_dir if output_dir is None else output_dir, name + '.img')
+
+
+def conversion_file(img_file):
+    # parameters an .img was converted with: ct.img -> ct.img.json
+    return img_file + '.json'
+
+
+def conversion_parameters(crop=None, resample=None, hu_luts=None):
+    # as stored in conversion_file; the HU tables are identified by a hash of their contents
+    hu_conversion = None
+    if hu_luts is not None:
+        h = hashlib.sha1()
+        for lut in hu_luts:
+            h.update(lut.tobytes())
+        hu_conversion = h.hexdigest()
+    return {'crop': None if crop is None else [int(c) for c in crop],
+            'resample': None if resample is None else [float(r) for r in resample],
+            'hu_conversion': hu_conversion}
+
+
+def is_up_to_date(series_dir, img_file, crop=None, resample=None, hu_luts=None):
+    # every output newer than the series and converted with the same parameters
+    outputs = [img_file, conversion_file(img_file)]
+    if hu_luts is not None:
+        outputs.extend(hu_conversion_files(img_file))
+    if not all(os.path.isfile(f) for f in outputs):
+        return False
+    try:
+        with open(conversion_file(img_file)) as f:
+            if json.load(f) != conversion_parameters(crop, resample, hu_luts):
+                return False
+    except ValueError:
+        return False
+    newest = max(os.path.getmtime(os.path.join(series_dir, f)) for f in os.listdir(series_dir) if f.endswith('.dcm'))
+    return min(os.path.getmtime(f) for f in outputs) >= newest
+
+
+def convert_series(series_dir, img_file, crop=None, resample=None, workers=1, hu_luts=None):
+    # convert one series and return its summary: geometry, rescale and timing of each stage
+    summary = {'series': series_dir, 'output': img_file}
+    t0 = time.perf_counter()
+    ct = ct_img()
+    ct.dir = series_dir
+    ct.read_dicom_headers(series_dir)
+    t1 = time.perf_counter()
+    ct.decode_dicom(workers=workers)
+    t2 = time.perf_counter()
+    summary['source'] = {'nx': ct.nx, 'ny': ct.ny, 'nz': ct.nz,
+                         'dx': float(ct.dx), 'dy': float(ct.dy), 'dz': float(ct.dz),
+                         'rescale_slope': ct.rescale_slope, 'rescale_intercept': ct.rescale_intercept}
+    if crop is not None:
+        ct = ct.crop(*crop)
+    if resample is not None:
+        ct = ct.resample(*resample, workers=workers)
+    t3 = time.perf_counter()
+    ct.write_img(img_file, hu_luts=hu_luts)
+    if hu_luts is not None:
+        summary['density'], summary['material'] = hu_conversion_files(img_file)
+    with open(conversion_file(img_file), 'w') as f:
+        json.dump(conversion_parameters(crop, resample, hu_luts), f, indent=2)
+    t4 = time.perf_counter()
+    summary['output_geometry'] = {'nx': ct.nx, 'ny': ct.ny, 'nz': ct.nz,
+                                  'dx': float(ct.dx), 'dy': float(ct.dy), 'dz': float(ct.dz)}
+    summary['timing'] = {'headers': t1 - t0, 'decode': t2 - t1, 'crop_resample': t3 - t2, 'write': t4 - t3, 'total': t4 - t0}
+    summary['status'] = 'converted'
+    return summary
+
+
+def _convert_job(args):
+    series_dir, img_file, crop, resample, hu_luts = args
+    try:
+        return convert_series(series_dir, img_file, crop, resample, hu_luts=hu_luts)
+    except Exception as e:
+        return {'series': series_dir, 'output': img_file, 'status': 'failed', 'error': str(e)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert DICOM series folders into .img files.')
+    parser.add_argument('paths', nargs='+', help='series folders, or root folders with --scan')
+    parser.add_argument('--scan', action='store_true', help='convert every folder with .dcm files below the given roots')
+    parser.add_argument('-o', '--output-dir', help='folder for the .img files (default: inside each series folder)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of series converted in parallel')
+    parser.add_argument('--crop', type=int, nargs=6, metavar=('X1', 'X2', 'Y1', 'Y2', 'Z1', 'Z2'),
+                        help='inclusive voxel bounds to keep, as the cut box in the GUI')
+    parser.add_argument('--resample', type=float, nargs=3, metavar=('DX', 'DY', 'DZ'),
+                        help='new voxel size in mm (volume average as img_resize)')
+    parser.add_argument('--hu-conversion', nargs='?', const='', metavar='JSON',
+                        help='also write density and material volumes, with the default or the given calibration')
+    parser.add_argument('--force', action='store_true', help='convert even if the outputs are up to date')
+    parser.add_argument('--summary', help='write a JSON summary of every series to this file')
+    args = parser.parse_args(argv)
+
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    hu_luts = None
+    if args.hu_conversion is not None:
+        hu_luts = read_hu_conversion(args.hu_conversion) if args.hu_conversion else hu_conversion_luts()
+    missing = [p for p in args.paths if not os.path.isdir(p)]
+    if missing:
+        print('Folders not found: ' + ', '.join(missing))
+        return 1
+    series = find_series(args.paths, args.scan)
+    if len(series) == 0:
+        print('No DICOM series are found.')
+        return 1
+
+    targets = {}
+    for s, root in series:
+        img_file = output_file(s, args.output_dir, root)
+        key = os.path.normcase(os.path.abspath(img_file))
+        if key in targets:
+            print('{:} and {:} would both be written to {:}'.format(targets[key], s, img_file))
+            return 1
+        targets[key] = s
+
+    results = []
+    jobs = []
+    for s, root in series:
+        img_file = output_file(s, args.output_dir, root)
+        if not args.force and is_up_to_date(s, img_file, args.crop, args.resample, hu_luts):
+            results.append({'series': s, 'output': img_file, 'status': 'skipped'})
+        else:
+            jobs.append((s, img_file, args.crop, args.resample, hu_luts))
+    print('{:d} series: {:d} to convert, {:d} up to date'.format(len(series), len(jobs), len(series) - len(jobs)))
+
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [pool.submit(_convert_job, job) for job in jobs]
+        for i, future in enumerate(as_completed(futures)):
+            result = future.result()
+            results.append(result)
+            if result['status'] == 'failed':
+                print('[{:d}/{:d}] {:} failed: {:}'.format(i + 1, len(jobs), result['series'], result['error']))
+            else:
+                g = result['output_geometry']
+                print('[{:d}/{:d}] {:} -> {:} ({:d} x {:d} x {:d}) in {:.1f} s'.format(
+                    i + 1, len(jobs), result['series'], result['output'], g['nx'], g['ny'], g['nz'], result['timing']['total']))
+    print('Done in {:.1f} s'.format(time.perf_counter() - t0))
+
+    if args.summary is not None:
+        with open(args.summary, 'w') as f:
+            json.dump({'crop': args.crop, 'resample': args.resample, 'hu_conversion': args.hu_conversion, 'series': results}, f, indent=2)
+    return 1 if any(r['status'] == 'failed' for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
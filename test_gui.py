@@ -0,0 +1,53 @@
+# Offscreen tests of the GUI loading paths
+#
+# Usage: python -m pytest test_gui.py
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('PyQt5')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from PyQt5.QtWidgets import QApplication, QFileDialog
+from ct_image import ct_img
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QApplication.instance() or QApplication([])
+
+
+@pytest.fixture
+def window(app, monkeypatch):
+    import CT_gui
+    w = CT_gui.myApp()
+    errors = []
+    monkeypatch.setattr(w, 'showMsg', lambda text, error=True: errors.append(text) if error else None)
+    w.errors = errors
+    yield w
+    if w.loader is not None:
+        w.loader.cancel()
+        w.loader.wait()
+    w.close()
+
+
+def open_file(app, window, monkeypatch, img_file):
+    monkeypatch.setattr(QFileDialog, 'getOpenFileName', staticmethod(lambda *args, **kwargs: (img_file, '')))
+    window.openFile()
+    window.loader.wait()
+    app.processEvents()
+
+
+@pytest.mark.parametrize('version', [1, 2])
+def test_open_img(app, window, monkeypatch, tmp_path, version):
+    ct = ct_img()
+    ct.nx, ct.ny, ct.nz = 40, 32, 12
+    ct.dx, ct.dy, ct.dz = np.float32(1.), np.float32(1.), np.float32(2.)
+    ct.voxel = np.random.default_rng(version).integers(-1024, 2000, size=(ct.nz, ct.ny, ct.nx), dtype=np.int16)
+    img_file = str(tmp_path / 'ct.img')
+    ct.write_img(img_file, version=version)
+
+    open_file(app, window, monkeypatch, img_file)
+    assert window.errors == []
+    assert (window.ct.nx, window.ct.ny, window.ct.nz) == (ct.nx, ct.ny, ct.nz)
+    assert window.ct.summed is not None
+    np.testing.assert_array_equal(np.asarray(window.ct.voxel), ct.voxel)
@@ -0,0 +1,81 @@
+# Tests of the chunked v2 .img format and of indexing a lazily read chunked_volume
+#
+# Usage: python -m pytest test_img_v2.py
+import numpy as np
+import pytest
+from ct_image import ct_img, chunked_volume
+
+SHAPE = (11, 13, 17)    # (nz, ny, nx), not a multiple of the chunks on any axis
+CHUNKS = (4, 5, 6)
+
+KEYS = [
+    5, -1, (3, 4), (3, 4, 5), (-2, -3, -4),
+    slice(None), slice(2, 9), slice(None, None, 3), slice(None, None, -1), slice(9, 2, -2), slice(5, 5),
+    (slice(1, 10, 2), slice(None), 7), (4, slice(12, None, -3), slice(3, 15)),
+    (slice(None), 6, slice(None, None, -5)), (slice(-4, None), slice(-6, -1), slice(None, 4)),
+]
+
+
+def make_ct(shape=SHAPE, seed=0):
+    ct = ct_img()
+    ct.nz, ct.ny, ct.nx = shape
+    ct.dx, ct.dy, ct.dz = np.float32(0.9765625), np.float32(0.9765625), np.float32(2.5)
+    ct.voxel = np.random.default_rng(seed).integers(-1024, 3000, size=shape, dtype=np.int16)
+    return ct
+
+
+@pytest.fixture
+def v2_file(tmp_path):
+    ct = make_ct()
+    img_file = str(tmp_path / 'ct.img')
+    ct.write_img(img_file, version=2, chunks=CHUNKS)
+    return ct, img_file
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_round_trip(v2_file, lazy):
+    ct, img_file = v2_file
+    read = ct_img(img_file, mmap=lazy)
+    assert isinstance(read.voxel, chunked_volume) == lazy
+    assert (read.nx, read.ny, read.nz) == (ct.nx, ct.ny, ct.nz)
+    assert (read.dx, read.dy, read.dz) == (ct.dx, ct.dy, ct.dz)
+    np.testing.assert_array_equal(np.asarray(read.voxel), ct.voxel)
+
+
+def test_box_round_trip(tmp_path):
+    ct = make_ct()
+    img_file = str(tmp_path / 'crop.img')
+    ct.write_img(img_file, box=(2, 15, 1, 9, 3, 10), version=2, chunks=CHUNKS)
+    np.testing.assert_array_equal(ct_img(img_file).voxel, ct.voxel[3:11, 1:10, 2:16])
+
+
+@pytest.mark.parametrize('key', KEYS)
+def test_indexing_matches_numpy(v2_file, key):
+    ct, img_file = v2_file
+    volume = chunked_volume(img_file, cache_size=4)
+    np.testing.assert_array_equal(volume[key], ct.voxel[key])
+    assert volume.shape == ct.voxel.shape and volume.size == ct.voxel.size
+
+
+def test_reads_survive_overwrite(v2_file):
+    ct, img_file = v2_file
+    read = ct_img(img_file, mmap=True)
+    read.write_img(img_file, box=(0, 5, 0, 5, 0, 5), version=2)
+    np.testing.assert_array_equal(read.voxel[-1], ct.voxel[-1])
+    assert ct_img(img_file).voxel.shape == (6, 6, 6)
+
+
+def test_read_dose_keeps_volume_lazy(v2_file, tmp_path):
+    ct, img_file = v2_file
+    block = np.random.default_rng(1).random((5, ct.ny, 8), dtype=np.float32)
+    ct.dose_x, ct.dose_z, ct.dose_e = 5, 3, np.float32(6.)
+    ct.dose_x0, ct.dose_x1, ct.dose_z0, ct.dose_z1 = 2, 9, 1, 5
+    ct.set_dose_block(block)
+    dose_file = str(tmp_path / 'ct.dose')
+    ct.write_dose(dose_file)
+
+    read = ct_img(img_file, mmap=True)
+    read.read_dose(dose_file)
+    assert len(read.voxel.cache) == 0
+    np.testing.assert_array_equal(read.dose[1:6, :, 2:10], block)
+    assert read.dose.sum() == pytest.approx(block.sum(), rel=1e-5)
@@ -0,0 +1,72 @@
+# Regression test of ct_img.resample against img_resize.c
+#
+# Usage: python -m pytest test_resample.py
+import os
+import shutil
+import subprocess
+import numpy as np
+import pytest
+from ct_image import ct_img
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CC = shutil.which('cc') or shutil.which('gcc') or shutil.which('clang')
+
+# (nx, ny, nz), (dx, dy, dz) -> new (dx, dy, dz); down, up and mixed sampling.  img_resize
+# sums in float32 and resample in float64, so where the weights are not exact in binary a
+# few values that land on an integer may be truncated one HU apart.
+GEOMETRIES = [
+    ((64, 48, 20), (1.0, 1.0, 2.5), (2.0, 2.0, 5.0), True),
+    ((32, 32, 16), (2.0, 2.0, 4.0), (1.0, 0.5, 2.0), True),
+    ((50, 40, 16), (0.9765625, 0.9765625, 3.0), (1.5, 1.25, 2.0), False),
+    ((32, 30, 12), (2.0, 2.0, 3.0), (0.7, 0.9, 1.1), False),
+    ((40, 36, 18), (1.2, 0.8, 2.0), (0.5, 1.7, 3.3), False),
+]
+
+
+@pytest.fixture(scope='module')
+def img_resize(tmp_path_factory):
+    if CC is None:
+        pytest.skip('no C compiler')
+    exe = str(tmp_path_factory.mktemp('bin') / 'img_resize')
+    subprocess.run([CC, '-O2', '-o', exe, os.path.join(HERE, 'img_resize.c'), '-lm'], check=True)
+    return exe
+
+
+@pytest.mark.parametrize('shape, voxel_size, new_voxel_size, exact', GEOMETRIES)
+def test_resample_matches_img_resize(img_resize, tmp_path, shape, voxel_size, new_voxel_size, exact):
+    nx, ny, nz = shape
+    ct = ct_img()
+    ct.nx, ct.ny, ct.nz = nx, ny, nz
+    ct.dx, ct.dy, ct.dz = (np.float32(d) for d in voxel_size)
+    ct.voxel = np.random.default_rng(nx * ny * nz).integers(-1024, 3000, size=(nz, ny, nx), dtype=np.int16)
+    img_file = str(tmp_path / 'ct.img')
+    ct.write_img(img_file)
+
+    subprocess.run([img_resize, img_file] + ['{:}'.format(d) for d in new_voxel_size], check=True, stdout=subprocess.DEVNULL)
+    expected = ct_img()
+    expected.read_img(img_file + '_new')
+    resampled = ct.resample(*new_voxel_size, workers=2)
+
+    assert (resampled.nx, resampled.ny, resampled.nz) == (expected.nx, expected.ny, expected.nz)
+    assert (resampled.dx, resampled.dy, resampled.dz) == (expected.dx, expected.dy, expected.dz)
+    if exact:
+        np.testing.assert_array_equal(resampled.voxel, expected.voxel)
+    else:
+        diff = np.abs(resampled.voxel.astype(np.int32) - expected.voxel)
+        assert diff.max() <= 1
+        assert np.count_nonzero(diff) <= diff.size // 1000
+
+
+def test_resample_stops_when_callback_returns_false():
+    ct = ct_img()
+    ct.nx, ct.ny, ct.nz = 16, 16, 64
+    ct.dx, ct.dy, ct.dz = np.float32(1.), np.float32(1.), np.float32(1.)
+    ct.voxel = np.zeros((ct.nz, ct.ny, ct.nx), dtype=np.int16)
+    calls = []
+    def callback(done, total):
+        calls.append((done, total))
+        return False
+    assert ct.resample(1., 1., 1., chunk=8, workers=2, callback=callback) is None
+    assert calls == [(8, 64)]
+    assert ct.build_pyramid(min_size=8, callback=callback) is None
+    assert ct.pyramid == []
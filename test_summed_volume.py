@@ -0,0 +1,30 @@
+# Tests of the block summed-volume tables behind ct_img.box_stats
+#
+# Usage: python -m pytest test_summed_volume.py
+import numpy as np
+import pytest
+from ct_image import ct_img, summed_volume
+
+
+@pytest.mark.parametrize('shape', [(13, 17, 22), (8, 8, 8), (1, 5, 3), (30, 33, 41)])
+@pytest.mark.parametrize('block', [1, 4, 5])
+def test_stats_match_numpy(shape, block):
+    rng = np.random.default_rng(block)
+    voxel = rng.integers(-1024, 3000, size=shape, dtype=np.int16)
+    summed = summed_volume(voxel, slab=7, block=block)
+    for i in range(100):
+        (z1, z2), (y1, y2), (x1, x2) = (sorted(rng.integers(0, n, 2)) for n in shape)
+        n, mean, std = summed.stats((x1, x2, y1, y2, z1, z2))
+        values = voxel[z1:z2+1, y1:y2+1, x1:x2+1].astype(np.float64)
+        assert n == values.size
+        assert mean == pytest.approx(values.mean(), abs=1e-9)
+        assert std == pytest.approx(values.std(), abs=1e-6)
+
+
+def test_box_stats_without_tables():
+    ct = ct_img()
+    ct.voxel = np.random.default_rng(0).integers(-1024, 3000, size=(10, 12, 14), dtype=np.int16)
+    box = (2, 9, 0, 11, 3, 7)
+    expected = ct.box_stats(box)
+    ct.build_summed_volume()
+    assert ct.box_stats(box) == pytest.approx(expected)